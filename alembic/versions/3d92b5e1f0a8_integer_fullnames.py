@@ -0,0 +1,130 @@
+"""Store reddit fullnames as (kind, base36 int) integer pairs
+
+Revision ID: 3d92b5e1f0a8
+Revises: 1f6a0c83d4e7
+Create Date: 2026-10-17 11:31:52.907713
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3d92b5e1f0a8'
+down_revision = '1f6a0c83d4e7'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+# (table, old string column, new kind column, new id column, indexed)
+FULLNAMES = [
+    ('battles', 'submission_id', 'submission_kind', 'submission_num', True),
+    ('processed', 'id36', 'id36_kind', 'id36_num', True),
+    ('skirmish_actions', 'comment_id', 'comment_kind', 'comment_num', True),
+    ('skirmish_actions', 'summary_id', 'summary_kind', 'summary_num', False),
+]
+
+
+def name_to_pair(name):
+    if name is None:
+        return None, None
+    if "_" in name:
+        kind, id36 = name.split("_", 1)
+        return int(kind.lstrip("t")), int(id36, 36)
+    return None, int(name, 36)
+
+
+def pair_to_name(kind, num):
+    if num is None:
+        return None
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    id36 = ""
+    while num:
+        num, i = divmod(num, 36)
+        id36 = digits[i] + id36
+    id36 = id36 or "0"
+    if kind is None:
+        return id36
+    return "t%d_%s" % (kind, id36)
+
+
+def _upgrade():
+    conn = op.get_bind()
+    for tablename, old, kind, num, indexed in FULLNAMES:
+        op.add_column(tablename, sa.Column(kind, sa.Integer(), nullable=True))
+        op.add_column(tablename, sa.Column(num, sa.Integer(), nullable=True))
+        table = sa.sql.table(tablename, sa.sql.column('id'),
+                             sa.sql.column(old), sa.sql.column(kind),
+                             sa.sql.column(num))
+        rows = conn.execute(sa.select([table.c.id, table.c[old]]).
+                            where(table.c[old] != None)).fetchall()
+        updates = []
+        for row_id, name in rows:
+            k, n = name_to_pair(name)
+            updates.append({'_id': row_id, '_kind': k, '_num': n})
+        if updates:
+            conn.execute(table.update().
+                         where(table.c.id == sa.bindparam('_id')).
+                         values({kind: sa.bindparam('_kind'),
+                                 num: sa.bindparam('_num')}),
+                         updates)
+        if indexed:
+            op.create_index('ix_%s_%s' % (tablename, num), tablename, [num],
+                            unique=False)
+    op.drop_index('ix_processed_id36', 'processed')
+    for tablename, old, kind, num, indexed in FULLNAMES:
+        op.drop_column(tablename, old)
+
+
+def _downgrade():
+    conn = op.get_bind()
+    for tablename, old, kind, num, indexed in FULLNAMES:
+        op.add_column(tablename, sa.Column(old, sa.String(), nullable=True))
+        table = sa.sql.table(tablename, sa.sql.column('id'),
+                             sa.sql.column(old), sa.sql.column(kind),
+                             sa.sql.column(num))
+        rows = conn.execute(sa.select([table.c.id, table.c[kind],
+                                       table.c[num]]).
+                            where(table.c[num] != None)).fetchall()
+        updates = [{'_id': row_id, '_name': pair_to_name(k, n)}
+                   for row_id, k, n in rows]
+        if updates:
+            conn.execute(table.update().
+                         where(table.c.id == sa.bindparam('_id')).
+                         values({old: sa.bindparam('_name')}),
+                         updates)
+        if indexed:
+            op.drop_index('ix_%s_%s' % (tablename, num), tablename)
+        op.drop_column(tablename, num)
+        op.drop_column(tablename, kind)
+    op.create_index('ix_processed_id36', 'processed', ['id36'], unique=False)
+
+
+def upgrade_engine1():
+    _upgrade()
+
+
+def downgrade_engine1():
+    _downgrade()
+
+
+def upgrade_engine2():
+    _upgrade()
+
+
+def downgrade_engine2():
+    _downgrade()
+
+
+def upgrade_engine3():
+    _upgrade()
+
+
+def downgrade_engine3():
+    _downgrade()
@@ -0,0 +1,88 @@
+"""Denormalize root_id and depth onto skirmish_actions
+
+Revision ID: 8e2f4b6a1c35
+Revises: 7c0e3a95b1d4
+Create Date: 2026-10-17 14:02:37.118204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8e2f4b6a1c35'
+down_revision = '7c0e3a95b1d4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def _upgrade():
+    op.add_column('skirmish_actions',
+                  sa.Column('root_id', sa.Integer(), nullable=True))
+    op.add_column('skirmish_actions',
+                  sa.Column('depth', sa.Integer(), nullable=True))
+    op.create_index('ix_skirmish_actions_root_id', 'skirmish_actions',
+                    ['root_id'], unique=False)
+
+    # Backfill a level at a time, starting from the roots
+    conn = op.get_bind()
+    table = sa.sql.table('skirmish_actions', sa.sql.column('id'),
+                         sa.sql.column('parent_id'), sa.sql.column('root_id'),
+                         sa.sql.column('depth'))
+    parents = dict(conn.execute(sa.select([table.c.id, table.c.parent_id])).
+                   fetchall())
+    children = {}
+    for row_id, parent_id in parents.items():
+        children.setdefault(parent_id, []).append(row_id)
+
+    updates = []
+    level = [(row_id, row_id) for row_id in children.get(None, [])]
+    depth = 0
+    while level:
+        updates.extend({'_id': row_id, '_root_id': root_id, '_depth': depth}
+                       for row_id, root_id in level)
+        level = [(child, root_id) for row_id, root_id in level
+                 for child in children.get(row_id, [])]
+        depth += 1
+    if updates:
+        conn.execute(table.update().
+                     where(table.c.id == sa.bindparam('_id')).
+                     values(root_id=sa.bindparam('_root_id'),
+                            depth=sa.bindparam('_depth')),
+                     updates)
+
+
+def _downgrade():
+    op.drop_index('ix_skirmish_actions_root_id', 'skirmish_actions')
+    op.drop_column('skirmish_actions', 'depth')
+    op.drop_column('skirmish_actions', 'root_id')
+
+
+def upgrade_engine1():
+    _upgrade()
+
+
+def downgrade_engine1():
+    _downgrade()
+
+
+def upgrade_engine2():
+    _upgrade()
+
+
+def downgrade_engine2():
+    _downgrade()
+
+
+def upgrade_engine3():
+    _upgrade()
+
+
+def downgrade_engine3():
+    _downgrade()
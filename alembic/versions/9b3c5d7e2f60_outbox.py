@@ -0,0 +1,68 @@
+"""Add the outbox table for queued replies, PMs and edits
+
+Revision ID: 9b3c5d7e2f60
+Revises: 8e2f4b6a1c35
+Create Date: 2026-10-17 16:21:08.440917
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9b3c5d7e2f60'
+down_revision = '8e2f4b6a1c35'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def _upgrade():
+    op.create_table('outbox',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('key', sa.String(length=40), nullable=True),
+                    sa.Column('priority', sa.Integer(), nullable=True),
+                    sa.Column('state', sa.String(length=8), nullable=True),
+                    sa.Column('kind', sa.String(length=8), nullable=True),
+                    sa.Column('target', sa.String(), nullable=True),
+                    sa.Column('subject', sa.String(), nullable=True),
+                    sa.Column('body', sa.String(), nullable=True),
+                    sa.Column('created', sa.Integer(), nullable=True),
+                    sa.Column('attempts', sa.Integer(), nullable=True),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('key'))
+    op.create_index('ix_outbox_state', 'outbox', ['state'], unique=False)
+
+
+def _downgrade():
+    op.drop_index('ix_outbox_state', 'outbox')
+    op.drop_table('outbox')
+
+
+def upgrade_engine1():
+    _upgrade()
+
+
+def downgrade_engine1():
+    _downgrade()
+
+
+def upgrade_engine2():
+    _upgrade()
+
+
+def downgrade_engine2():
+    _downgrade()
+
+
+def upgrade_engine3():
+    _upgrade()
+
+
+def downgrade_engine3():
+    _downgrade()
@@ -0,0 +1,72 @@
+"""Index the columns we look rows up by
+
+Revision ID: a4f1c8e93b27
+Revises: 9b3c5d7e2f60
+Create Date: 2026-10-17 17:05:44.613092
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a4f1c8e93b27'
+down_revision = '9b3c5d7e2f60'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+# (index name, table, columns)
+INDEXES = [
+    ('ix_users_name', 'users', ['name']),
+    ('ix_regions_name', 'regions', ['name']),
+    ('ix_regions_srname', 'regions', ['srname']),
+    ('ix_regions_capital', 'regions', ['capital']),
+    ('ix_marching_orders_leader_id', 'marching_orders', ['leader_id']),
+    ('ix_codewords_user_id_code', 'codewords', ['user_id', 'code']),
+    ('ix_processed_battle_id', 'processed', ['battle_id']),
+    ('ix_skirmish_actions_battle_id', 'skirmish_actions', ['battle_id']),
+    ('ix_skirmish_actions_participant_id', 'skirmish_actions',
+     ['participant_id']),
+    ('ix_skirmish_actions_parent_id', 'skirmish_actions', ['parent_id']),
+]
+
+
+def _upgrade():
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, unique=False)
+
+
+def _downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table)
+
+
+def upgrade_engine1():
+    _upgrade()
+
+
+def downgrade_engine1():
+    _downgrade()
+
+
+def upgrade_engine2():
+    _upgrade()
+
+
+def downgrade_engine2():
+    _downgrade()
+
+
+def upgrade_engine3():
+    _upgrade()
+
+
+def downgrade_engine3():
+    _downgrade()
@@ -0,0 +1,59 @@
+"""Multi-leg routes for marching orders
+
+Revision ID: b7d2e4f6a813
+Revises: a4f1c8e93b27
+Create Date: 2026-10-17 17:48:21.095337
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b7d2e4f6a813'
+down_revision = 'a4f1c8e93b27'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def _upgrade():
+    # Orders already underway have no route, which means straight to dest
+    op.add_column('marching_orders',
+                  sa.Column('route', sa.String(), nullable=True))
+    op.add_column('marching_orders',
+                  sa.Column('leg', sa.Integer(), nullable=True))
+
+
+def _downgrade():
+    op.drop_column('marching_orders', 'leg')
+    op.drop_column('marching_orders', 'route')
+
+
+def upgrade_engine1():
+    _upgrade()
+
+
+def downgrade_engine1():
+    _downgrade()
+
+
+def upgrade_engine2():
+    _upgrade()
+
+
+def downgrade_engine2():
+    _downgrade()
+
+
+def upgrade_engine3():
+    _upgrade()
+
+
+def downgrade_engine3():
+    _downgrade()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+Times the bot's common lookups against a seeded sqlite database, first
+without the lookup indexes and then with them.
+
+    bin/benchmark_indexes.py [users] [repeats]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(".")
+sys.path.append("./chromabot")
+
+from db import (Base, DB, Battle, CodeWord, MarchingOrder, Processed, Region,
+                SkirmishAction, User)
+
+# The indexes added by alembic revision a4f1c8e93b27
+INDEXES = ['ix_users_name', 'ix_regions_name', 'ix_regions_srname',
+           'ix_regions_capital', 'ix_marching_orders_leader_id',
+           'ix_codewords_user_id_code', 'ix_processed_battle_id',
+           'ix_skirmish_actions_battle_id',
+           'ix_skirmish_actions_participant_id',
+           'ix_skirmish_actions_parent_id']
+
+REGIONS = 1000
+BATTLES = 100
+CHUNK = 10000
+
+
+class BenchConfig(object):
+    def __init__(self, path):
+        self.dbstring = "sqlite:///%s" % path
+
+
+def insert(conn, table, rows):
+    for start in xrange(0, len(rows), CHUNK):
+        conn.execute(table.insert(), rows[start:start + CHUNK])
+
+
+def seed(db, users):
+    """Fill the database with users and everything that hangs off them"""
+    conn = db.engine.connect()
+    trans = conn.begin()
+    insert(conn, Region.__table__, [
+        {'id': i, 'name': "region%d" % i, 'srname': "ct_region%d" % i,
+         'capital': i if i < 2 else None, 'owner': i % 2}
+        for i in xrange(REGIONS)])
+    insert(conn, User.__table__, [
+        {'id': i, 'name': "user%d" % i, 'team': i % 2, 'loyalists': 100,
+         'region_id': i % REGIONS}
+        for i in xrange(users)])
+    insert(conn, CodeWord.__table__, [
+        {'user_id': i / 2, 'code': "code%d" % (i % 2), 'word': "infantry"}
+        for i in xrange(users * 2)])
+    insert(conn, MarchingOrder.__table__, [
+        {'leader_id': i * 10, 'arrival': i, 'source_id': 0, 'dest_id': 1}
+        for i in xrange(users / 10)])
+    insert(conn, Battle.__table__, [
+        {'id': i, 'region_id': i, 'begins': 0, 'ends': 0}
+        for i in xrange(BATTLES)])
+    # Two skirmish actions and two processed comments per user
+    insert(conn, SkirmishAction.__table__, [
+        {'id': i, 'battle_id': i % BATTLES, 'participant_id': i / 2,
+         'parent_id': i - BATTLES if i >= BATTLES else None, 'amount': 1}
+        for i in xrange(users * 2)])
+    insert(conn, Processed.__table__, [
+        {'id36_num': i, 'battle_id': i % BATTLES}
+        for i in xrange(users * 2)])
+    trans.commit()
+    conn.close()
+
+
+def lookups(sess, users):
+    """The queries the bot makes, as (description, callable) pairs"""
+    def user():
+        return random.randrange(users)
+
+    def region():
+        return random.randrange(REGIONS)
+
+    def battle():
+        return random.randrange(BATTLES)
+
+    return [
+        ("User by name",
+         lambda: sess.query(User).filter_by(name="user%d" % user()).first()),
+        ("Region by name",
+         lambda: sess.query(Region).filter_by(
+             name="region%d" % region()).first()),
+        ("Region by srname",
+         lambda: sess.query(Region).filter_by(
+             srname="ct_region%d" % region()).first()),
+        ("Region.capital_for",
+         lambda: Region.capital_for(random.randrange(2), sess)),
+        ("Codeword for a user",
+         lambda: sess.query(CodeWord).filter_by(
+             user_id=user(), code="code1").first()),
+        ("Marching orders for a leader",
+         lambda: sess.query(MarchingOrder).filter_by(
+             leader_id=user()).all()),
+        ("Skirmishes by participant",
+         lambda: sess.query(SkirmishAction).filter_by(
+             participant_id=user()).all()),
+        ("Skirmish children",
+         lambda: sess.query(SkirmishAction).filter_by(
+             parent_id=user()).all()),
+        ("Skirmishes in a battle",
+         lambda: sess.query(SkirmishAction.id).filter_by(
+             battle_id=battle()).all()),
+        ("Processed in a battle",
+         lambda: sess.query(Processed.id36_num).filter_by(
+             battle_id=battle()).all()),
+    ]
+
+
+def timings(db, users, repeats):
+    """Average milliseconds per lookup"""
+    sess = db.session()
+    result = []
+    for name, query in lookups(sess, users):
+        random.seed(0)
+        start = time.time()
+        for _ in xrange(repeats):
+            query()
+            sess.expunge_all()
+        result.append((name, (time.time() - start) * 1000.0 / repeats))
+    sess.close()
+    return result
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    handle, path = tempfile.mkstemp(suffix=".db")
+    os.close(handle)
+    try:
+        db = DB(BenchConfig(path))
+        db.create_all()
+        indexes = [index for table in Base.metadata.tables.values()
+                   for index in table.indexes if index.name in INDEXES]
+        for index in indexes:
+            index.drop(db.engine)
+        print "Seeding %d users..." % users
+        seed(db, users)
+        before = timings(db, users, repeats)
+        for index in indexes:
+            index.create(db.engine)
+        after = timings(db, users, repeats)
+    finally:
+        os.remove(path)
+
+    print "%-30s %12s %12s %8s" % ("Lookup", "before (ms)", "after (ms)",
+                                   "speedup")
+    for (name, slow), (_, fast) in zip(before, after):
+        print "%-30s %12.3f %12.3f %7.0fx" % (name, slow, fast,
+                                              slow / max(fast, 1e-6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+from collections import defaultdict, deque
+
+
+class Atlas(object):
+    """
+    The map, held in memory: which regions border which, who owns what,
+    what each region is called, how to get from one to another and where
+    each team can attack, all by region id.  The map itself hardly ever
+    changes, so ChromaSession builds one of these when it's first asked
+    for, follows regions changing hands with transfer(), and only throws
+    it away if anything else about the map is flushed, rather than the
+    game querying borders for every move and invasion.
+    """
+
+    def __init__(self, regions, borders):
+        """
+        regions are (id, name, srname, owner) rows, borders (left id,
+        right id) rows of the region_to_region table
+        """
+        self.by_name = {}
+        self.by_srname = {}
+        self.owner = {}
+        self.owned = defaultdict(set)    # team -> region ids
+        self.borders = defaultdict(set)  # region id -> adjacent region ids
+        # team -> source id -> destination id -> route, worked out for every
+        # pair at once the first time a team moves
+        self.routes = {}
+        # team -> regions it doesn't own but borders, so could invade
+        self.frontier = defaultdict(set)
+        # team -> (its region, other team's region) pairs that border
+        self.contested = defaultdict(set)
+        for rid, name, srname, owner in regions:
+            self.by_name[name] = rid
+            self.by_srname[srname] = rid
+            self.owner[rid] = owner
+            if owner is not None:
+                self.owned[owner].add(rid)
+        for left, right in borders:
+            self.borders[left].add(right)
+            self.borders[right].add(left)
+        for rid in self.owner:
+            self.recheck(rid)
+
+    def recheck(self, rid):
+        """Bring the frontier and contested borders up to date around rid"""
+        owner = self.owner.get(rid)
+        neighbors = self.borders[rid]
+        for regions in self.frontier.values():
+            regions.discard(rid)
+        for team in set(self.owner.get(other) for other in neighbors):
+            if team is not None and team != owner:
+                self.frontier[team].add(rid)
+        for other in neighbors:
+            for pairs in self.contested.values():
+                pairs.discard((rid, other))
+                pairs.discard((other, rid))
+            theirs = self.owner.get(other)
+            if None not in (owner, theirs) and owner != theirs:
+                self.contested[owner].add((rid, other))
+                self.contested[theirs].add((other, rid))
+
+    def transfer(self, rid, owner):
+        """Region rid now belongs to owner"""
+        old = self.owner.get(rid)
+        if old == owner:
+            return
+        if old is not None:
+            self.owned[old].discard(rid)
+        if owner is not None:
+            self.owned[owner].add(rid)
+        self.owner[rid] = owner
+        # Only the two teams involved have new ways to go
+        self.routes.pop(old, None)
+        self.routes.pop(owner, None)
+        for each in [rid] + list(self.borders[rid]):
+            self.recheck(each)
+
+    def find(self, where):
+        """The id of the region named where, or with where as its srname"""
+        rid = self.by_name.get(where)
+        if rid is None:
+            rid = self.by_srname.get(where)
+        return rid
+
+    def adjacent(self, rid, other):
+        return other in self.borders[rid]
+
+    def route(self, team, source, dest):
+        """
+        The shortest way for team to get from source to dest, passing only
+        through regions it owns, as a tuple of the regions to go through in
+        order (ending with dest), or None if there's no such way.
+        """
+        if team not in self.routes:
+            self.routes[team] = dict((rid, self.routes_from(team, rid))
+                                     for rid in self.owner)
+        return self.routes[team].get(source, {}).get(dest)
+
+    def routes_from(self, team, source):
+        """Breadth first search out from source through team's regions"""
+        found = {}
+        queue = deque([(source, ())])
+        while queue:
+            rid, route = queue.popleft()
+            for adjacent in sorted(self.borders[rid]):
+                if adjacent == source or adjacent in found:
+                    continue
+                found[adjacent] = route + (adjacent,)
+                # Can go into anywhere, but only through friendly places
+                if self.owner.get(adjacent) == team:
+                    queue.append((adjacent, found[adjacent]))
+        return found
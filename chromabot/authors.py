@@ -0,0 +1,94 @@
+from collections import OrderedDict
+from functools import partial
+from itertools import chain
+
+from sqlalchemy import event
+from sqlalchemy.orm.attributes import get_history
+
+from db import User
+
+
+class AuthorCache(object):
+    """
+    Remembers which user each reddit name belongs to, or that it doesn't
+    belong to anyone, for the size most recently seen names, so the same
+    few hundred commenters in a battle thread don't each cost a query per
+    comment.
+
+    Only ids are kept; the User itself comes from the session's identity
+    map.  Entries are forgotten whenever a user is created, renamed,
+    changes team or is promoted, and again if that change is rolled back,
+    since ids handed out in a rolled back transaction can be reused.
+    Which threads a non-player has been told in is kept apart from that,
+    so nobody is told twice just because something rolled back.
+    """
+
+    # Changes to these mean a user's entry is out of date
+    WATCHED = ('name', 'team', 'leader')
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.entries = OrderedDict()    # name -> user id or None
+        self.told = OrderedDict()       # name -> threads told in
+        self.hits = 0
+        self.misses = 0
+
+    def watch(self, sess):
+        event.listen(sess, "after_flush", self.after_flush)
+
+    def after_flush(self, sess, flush_context):
+        changed = []
+        for obj in sess.new:
+            if isinstance(obj, User):
+                changed.append(obj.name)
+        for obj in chain(sess.dirty, sess.deleted):
+            if isinstance(obj, User):
+                if any(get_history(obj, attr).has_changes()
+                       for attr in self.WATCHED):
+                    changed.append(obj.name)
+                    changed.extend(get_history(obj, 'name').deleted)
+        for name in changed:
+            self.forget(name)
+            sess.on_rollback(partial(self.forget, name))
+
+    def forget(self, name):
+        self.entries.pop(name, None)
+
+    def remember(self, name, user_id):
+        self.entries[name] = user_id
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def find(self, sess, name):
+        """The User called name, or None if there isn't one"""
+        if name in self.entries:
+            # Most recently used goes to the end
+            user_id = self.entries.pop(name)
+            self.entries[name] = user_id
+            if user_id is None:
+                self.hits += 1
+                return None
+            user = sess.query(User).get(user_id)
+            if user and user.name == name:
+                self.hits += 1
+                return user
+        self.misses += 1
+        user = sess.query(User).filter_by(name=name).first()
+        self.remember(name, user.id if user else None)
+        return user
+
+    def tell(self, name, thread):
+        """
+        Whether to tell name, who isn't playing, so in thread: only the
+        first time they turn up there
+        """
+        if name not in self.entries or self.entries[name] is not None:
+            return True
+        threads = self.told.pop(name, set())
+        self.told[name] = threads
+        while len(self.told) > self.size:
+            self.told.popitem(last=False)
+        if thread in threads:
+            return False
+        threads.add(thread)
+        return True
@@ -0,0 +1,105 @@
+"""
+Keeps the bot from hammering reddit while it's down.  Every call made
+through commands.failable (only the innermost, when they're nested), and
+everything the outbox sends, is reported to a CircuitBreaker.  Once enough
+of them fail in a short time the circuit opens, and calls are skipped
+outright until a cooldown has passed; then they're let through again to see
+whether reddit is back.
+"""
+import logging
+import random
+import time
+
+import praw
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+
+# What reddit being unwell looks like
+ERRORS = (praw.errors.APIException, ConnectionError, Timeout, HTTPError)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, threshold=5, window=60, cooldown=120, retries=2,
+                 base_delay=1, max_delay=30, clock=time.time,
+                 sleep=time.sleep):
+        self.threshold = threshold    # Failures within window that trip it
+        self.window = window
+        self.cooldown = cooldown      # How long it stays open
+        self.retries = retries        # For calls that are safe to repeat
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+        self.reset()
+
+    def reset(self):
+        self.state = CLOSED
+        self.opened_at = None
+        self.recent = []    # When recent failures happened
+        self.calls = 0
+        self.failures = 0
+        self.skipped = 0
+        self.trips = 0
+
+    def configure(self, bot):
+        """Take settings from the bot section of the config"""
+        self.threshold = bot.get("breaker_threshold", self.threshold)
+        self.cooldown = bot.get("breaker_cooldown", self.cooldown)
+        self.retries = bot.get("retries", self.retries)
+
+    def allow(self):
+        """Whether to make a call now"""
+        if self.state == OPEN:
+            if self.clock() - self.opened_at < self.cooldown:
+                self.skipped += 1
+                return False
+            logging.info("Seeing whether reddit is back")
+            self.state = HALF_OPEN
+        return True
+
+    def success(self):
+        self.calls += 1
+        if self.state == HALF_OPEN:
+            logging.info("Reddit is back; closing the circuit")
+            self.state = CLOSED
+            self.recent = []
+
+    def failure(self):
+        current = self.clock()
+        self.calls += 1
+        self.failures += 1
+        self.recent = [when for when in self.recent
+                       if current - when < self.window]
+        self.recent.append(current)
+        if self.state == OPEN:
+            return
+        if self.state == HALF_OPEN or len(self.recent) >= self.threshold:
+            logging.warning("Reddit seems to be down; not calling it for "
+                            "%d seconds" % self.cooldown)
+            self.state = OPEN
+            self.opened_at = current
+            self.trips += 1
+
+    def backoff(self, attempt):
+        """How long to wait before retry number attempt (from 0), jittered"""
+        return random.uniform(0, min(self.max_delay,
+                                     self.base_delay * 2 ** attempt))
+
+    def describe(self):
+        if self.state == OPEN:
+            left = max(0, self.cooldown - (self.clock() - self.opened_at))
+            health = "down, trying again in %d seconds" % left
+        elif self.state == HALF_OPEN:
+            health = "recovering"
+        else:
+            health = "up"
+        return ("Reddit connection: %s (%d calls, %d failed, %d skipped)" %
+                (health, self.calls, self.failures, self.skipped))
+
+
+# The one everything shares
+reddit = CircuitBreaker()
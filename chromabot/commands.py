@@ -6,54 +6,114 @@ import traceback
 import praw
 from requests.exceptions import ConnectionError, HTTPError, Timeout
 
+import breaker
 import db
-from db import Battle, Region, Processed, SkirmishAction, User
+import outbound
+import simulation
+from db import Battle, Outgoing, Region, Processed, SkirmishAction, User
 from utils import now, num_to_team, team_to_num, timestr
 
 
-def failable(f):
+def failable(f, retry=False):
+    """
+    Turn reddit being unavailable into a None result, as reported to the
+    circuit breaker, and skip the call entirely while that's tripped.  With
+    retry, which is only for calls that are safe to repeat, failures are
+    retried a few times with backoff first.  Failable calls made from
+    inside this one report for themselves, and it only reports its own
+    success if none did.
+    """
     def wrapped(*args, **kwargs):
-        try:
-            return f(*args, **kwargs)
-        except praw.errors.APIException:
-            full = traceback.format_exc()
-            logging.warning("Reddit API call failed! %s" % full)
-            return None
-        except ConnectionError:
-            full = traceback.format_exc()
-            logging.warning("Connection error: %s", full)
-        except Timeout:
-            full = traceback.format_exc()
-            logging.warning("Socket timeout! %s" % full)
-            return None
-        except HTTPError:
-            full = traceback.format_exc()
-            logging.warning("HTTP error timeout! %s" % full)
-            return None
+        attempt = 0
+        while breaker.reddit.allow():
+            before = breaker.reddit.calls
+            try:
+                result = f(*args, **kwargs)
+                if breaker.reddit.calls == before:
+                    breaker.reddit.success()
+                return result
+            except praw.errors.APIException:
+                full = traceback.format_exc()
+                logging.warning("Reddit API call failed! %s" % full)
+            except ConnectionError:
+                full = traceback.format_exc()
+                logging.warning("Connection error: %s", full)
+            except Timeout:
+                full = traceback.format_exc()
+                logging.warning("Socket timeout! %s" % full)
+            except HTTPError:
+                full = traceback.format_exc()
+                logging.warning("HTTP error timeout! %s" % full)
+            breaker.reddit.failure()
+            if not retry or attempt >= breaker.reddit.retries:
+                return None
+            delay = breaker.reddit.backoff(attempt)
+            attempt += 1
+            logging.info("Retrying %s in %.1f seconds" % (f.__name__, delay))
+            breaker.reddit.sleep(delay)
+        return None
     return wrapped
 
 
+def retried(f):
+    """failable, retrying with backoff; only for calls safe to repeat"""
+    return failable(f, retry=True)
+
+
 class Context(object):
-    def __init__(self, player, config, session, comment, reddit):
+    def __init__(self, player, config, session, comment, reddit,
+                 summaries=None, outbox=None, seen=None):
         self.player = player    # a DB object
         self.config = config
         self.session = session
         self.comment = comment  # a praw object
         self.reddit = reddit    # root praw object
+        self.summaries = summaries  # a SummaryQueue, if edits are batched
+        self.outbox = outbox        # an Outbound, if replies are paced
+        # Names of every comment already handled in this battle, including
+        # earlier in this pass, if the caller keeps track
+        self.seen = seen
+
+    def reply(self, reply, pm=True, priority=outbound.CONFIRMATION):
+        """
+        Reply to the command, by PM unless pm is False.  With an outbox,
+        PMs are queued at the given priority; public replies still go out
+        straight away, as callers need the new comment back.
+        """
+        if self.outbox is None or not pm:
+            return self.send_reply(reply, pm)
+        if getattr(self.comment, 'was_comment', True):
+            self.outbox.enqueue(priority, 'pm', self.player.name,
+                                self.with_header(reply),
+                                subject="Chromabot reply")
+        else:
+            self.outbox.enqueue(priority, 'reply', self.comment.name, reply)
 
     @failable
-    def reply(self, reply, pm=True):
+    def send_reply(self, reply, pm=True):
         was_comment = getattr(self.comment, 'was_comment', True)
-        header = ""
-        if was_comment and pm:
-            header = ("(In response to [this comment](%s))" %
-                      self.comment.permalink)
-        else:  # It wasn't a comment, or pm = False
+        if not (was_comment and pm):  # It wasn't a comment, or pm = False
             return self.comment.reply(reply)
 
-        full_reply = "%s\n\n%s" % (header, reply)
         self.reddit.send_message(self.player.name, "Chromabot reply",
-                                 full_reply)
+                                 self.with_header(reply))
+
+    def with_header(self, reply):
+        # Comments from the stream don't know their submission, and praw's
+        # permalink would fetch the whole thread to find it out
+        link = getattr(self.comment, '_fast_permalink', None)
+        if link is None:
+            link = self.permalink()
+        if link is None:
+            return reply
+        header = "(In response to [this comment](%s))" % link
+        return "%s\n\n%s" % (header, reply)
+
+    @failable
+    def permalink(self):
+        # Replies are queued outside send_reply, so reddit being down here
+        # mustn't get out and take the rest of the frame with it
+        return self.comment.permalink
 
     @failable
     def submit(self, srname, title, text):
@@ -63,6 +123,90 @@ class Context(object):
         return num_to_team(self.player.team, self.config)
 
 
+class SummaryQueue(object):
+    """
+    Batches up edits to skirmish summary comments.  Reactions only mark
+    their root as dirty; flush() then edits each dirty summary once, and
+    not at all if it would say the same as what we last put there.
+    """
+
+    def __init__(self):
+        self.dirty = set()   # root skirmish ids
+        self.written = {}    # summary name -> text we last gave it
+        # summary name -> (root id, text) for edits queued in the outbox
+        # that we don't yet know went out
+        self.sending = {}
+
+    def mark(self, skirmish):
+        self.dirty.add(skirmish.get_root().id)
+
+    def posted(self, name, text):
+        """Note the text of a summary we've just created"""
+        self.written[name] = text
+
+    def forget(self, skirmish):
+        """Stop remembering a summary, e.g. once its battle is over"""
+        self.written.pop(skirmish.summary_id, None)
+        self.sending.pop(skirmish.summary_id, None)
+
+    def settle(self, session):
+        """
+        Catch up with the outbox: edits it's sent now count as written, and
+        ones that rolled back or that it gave up on are tried again
+        """
+        if not self.sending:
+            return
+        latest = {}
+        for item in (session.query(Outgoing).
+                     filter_by(kind='edit').
+                     filter(Outgoing.target.in_(list(self.sending))).
+                     order_by(Outgoing.id)):
+            latest[item.target] = item
+        for name, (root_id, text) in self.sending.items():
+            item = latest.get(name)
+            if item and item.body == text:
+                if item.state in ('queued', 'sending'):
+                    continue
+                if item.state == 'sent':
+                    self.written[name] = text
+                    del self.sending[name]
+                    continue
+            del self.sending[name]
+            self.dirty.add(root_id)
+
+    def flush(self, session, reddit, config, outbox=None):
+        """
+        Render every dirty summary, and edit the ones that changed - right
+        away, or via outbox if given
+        """
+        if outbox is not None:
+            self.settle(session)
+        dirty, self.dirty = self.dirty, set()
+        for root_id in sorted(dirty):
+            root = session.query(SkirmishAction).get(root_id)
+            # May have been rolled back since it was marked
+            if not root or not root.summary_id:
+                continue
+            name = root.summary_id
+            text = "\n\n".join(root.full_details(config=config))
+            if self.written.get(name) == text:
+                continue
+            if outbox is not None:
+                # Only written once it's been sent; see settle()
+                if self.sending.get(name, (None, None))[1] != text:
+                    outbox.enqueue(outbound.CONFIRMATION, 'edit', name, text)
+                    self.sending[name] = (root_id, text)
+            elif self.edit(reddit, name, text):
+                self.written[name] = text
+
+    @retried
+    def edit(self, reddit, name, text):
+        summary = reddit.get_info(thing_id=name)
+        if summary:
+            summary.edit(text)
+            return True
+
+
 class Command(object):
 
     FAIL_NOT_PLAYER = """
@@ -79,10 +223,10 @@ that, comment in the latest recruitment thread in /r/%s"""
     # Helper functions for subclasses
     def get_region(self, where, context, require=True):
         sess = context.session
-        dest = sess.query(Region).filter_by(name=where).first()
-        if not dest:
-            dest = sess.query(Region).filter_by(
-                srname=where).first()
+        dest = None
+        rid = sess.atlas().find(where)
+        if rid is not None:
+            dest = sess.query(Region).get(rid)
         if require and not dest:
             context.reply(
                 "I don't know any region or subreddit named '%s'" %
@@ -107,7 +251,7 @@ class CodewordCommand(Command):
                 cws = list(context.player.codewords)
                 for cw in cws:
                     context.session.delete(cw)
-                context.session.commit()
+                context.session.checkpoint()
                 context.reply("**Confirmed**:  You no longer have codewords")
             else:
                 context.player.remove_codeword(self.code)
@@ -185,7 +329,7 @@ class InvadeCommand(Command):
                 battle = dest.invade(context.player, begins)
                 if "battle_lockout" in context.config["game"]:
                     battle.lockout = context.config["game"]["battle_lockout"]
-                    context.session.commit()
+                    context.session.checkpoint()
             except db.RankException:
                 context.reply("You don't have the authority "
                               "to invade a region!")
@@ -208,7 +352,7 @@ class InvadeCommand(Command):
                                                         context.reddit)
                 if submitted:
                     battle.submission_id = submitted.name
-                    context.session.commit()
+                    context.session.checkpoint()
                 else:
                     logging.warn("Couldn't submit invasion thread")
                     context.session.rollback()
@@ -231,6 +375,7 @@ class MoveCommand(Command):
                 self.amount = context.player.loyalists
 
             try:
+                # Per region marched through
                 speed = context.config["game"]["speed"]
                 #hundred_followers = self.amount / 100
                 time_taken = speed  # * hundred_followers
@@ -242,7 +387,8 @@ class MoveCommand(Command):
                     (ie.requested, ie.available))
                 return
             except db.NonAdjacentException:
-                text = ("Your current region, %s, is not adjacent to %s" %
+                text = ("There's no way from your current region, %s, to %s "
+                        "through friendly territory" %
                     (context.player.region.markdown(), dest.markdown()))
                 if context.player.region == dest:
                     text = ("How can you go to %s when "
@@ -270,15 +416,23 @@ class MoveCommand(Command):
                 return
             context.player.defectable = False
             if order:
+                way = ""
+                hops = order.hops()
+                if len(hops) > 1:
+                    sess = context.session
+                    way = " by way of %s" % ", ".join(
+                        sess.query(Region).get(rid).markdown()
+                        for rid in hops[:-1])
                 context.reply((
-                    "**Confirmed**: You are leading %d of your people to %s. "
-                    "You will arrive at %s."
-                    ) % (self.amount, dest.markdown(), order.arrival_str()))
+                    "**Confirmed**: You are leading %d of your people to "
+                    "%s%s. You will arrive at %s."
+                    ) % (self.amount, dest.markdown(), way,
+                         order.arrival_str()))
             else:
                 context.reply((
                     "**Confirmed**: You have lead %d of your people to %s."
                     ) % (self.amount, dest.markdown()))
-            context.session.commit()
+            context.session.checkpoint()
 
     def __repr__(self):
         return "<MoveCommand(amount='%s', where='%s')>" % (
@@ -295,16 +449,38 @@ class StatusCommand(Command):
         for region in regions:
             dispute = ""
             if region.battle:
-                dispute = " ( %s )" % region.battle.markdown()
+                battle = region.battle
+                dispute = " ( %s )" % battle.markdown()
+                if battle.has_started():
+                    dispute = " ( %s: %s )" % (battle.markdown(),
+                                               battle.standings(config))
             result.append(fmt % (region.markdown(),
                                  num_to_team(region.owner, config),
                                  dispute))
         lands = "\n".join(result)
-        return "State of the Lands:\n\n" + lands
+        frontier = cls.frontier_status_for(session, config, regions)
+        return "State of the Lands:\n\n" + lands + "\n\n" + frontier
+
+    @classmethod
+    def frontier_status_for(cls, session, config, regions):
+        """Where each team can invade, from the map kept in memory"""
+        atlas = session.atlas()
+        by_id = dict((region.id, region) for region in regions)
+        result = []
+        for team in sorted(atlas.frontier):
+            targets = sorted((by_id[rid] for rid in atlas.frontier[team]),
+                             key=lambda region: region.name)
+            if not targets:
+                continue
+            result.append("* **%s** can invade %s (%d contested borders)" %
+                          (num_to_team(team, config),
+                           ", ".join(region.markdown() for region in targets),
+                           len(atlas.contested[team])))
+        return "Frontier:\n\n" + "\n".join(result)
 
     def execute(self, context):
         status = self.status_for(context)
-        context.reply(status)
+        context.reply(status, priority=outbound.MESSAGE)
 
     def lands_status(self, context):
         return StatusCommand.lands_status_for(context.session, context.config)
@@ -330,7 +506,8 @@ class StatusCommand(Command):
                   "%s")
         personal = result % (found.rank, context.team_name(),
                              found.loyalists, commit_str, forces)
-        return personal + "\n\n" + self.lands_status(context)
+        return "\n\n".join([personal, self.lands_status(context),
+                            breaker.reddit.describe()])
 
 
 class PromoteCommand(Command):
@@ -349,7 +526,7 @@ class PromoteCommand(Command):
                 person.leader = self.direction
                 context.reply("%s has been %sd!" % (self.who,
                                                     self.direction_str))
-                context.session.commit()
+                context.session.checkpoint()
             else:
                 context.reply("You can't promote if you aren't a leader "
                               "yourself!")
@@ -432,14 +609,17 @@ class SkirmishCommand(Command):
             if skirmish.get_root().id != skirmish.id:
                 subskirmish = " (subskirmish %d)" % skirmish.id
 
-            context.reply(("**Confirmed**: You have committed %d of your "
+            confirmation = ("**Confirmed**: You have committed %d of your "
                 "forces as **%s** to **Skirmish #%d**%s.\n\nAs of now, you "
-                "have committed %d total.  **For %s!**") %
-                          (skirmish.amount,
-                           skirmish.troop_type,
-                           skirmish.get_root().id,
-                           subskirmish,
-                           total, context.team_name()))
+                "have committed %d total.  **For %s!**") % (
+                    skirmish.amount,
+                    skirmish.troop_type,
+                    skirmish.get_root().id,
+                    subskirmish,
+                    total, context.team_name())
+            # Without an outbox this goes out now; with one it's only queued,
+            # and goes or not along with the rest of the command
+            confirmed = context.reply(confirmation)
 
             skirmish.comment_id = context.comment.name
             if not skirmish.parent:
@@ -449,18 +629,21 @@ class SkirmishCommand(Command):
                 rname = context.reply(details, pm=False)
                 if rname:
                     skirmish.summary_id = rname.name
+                    if context.summaries is not None:
+                        context.summaries.posted(rname.name, details)
                 else:
                     # Couldn't reply, bail!
                     context.session.rollback()
-                    context.reply("I'm sorry - an error occurred and "
-                                  "I coudn't commit your skirmish.  Disregard "
-                                  "the previous confirmation")
+                    if confirmed:
+                        context.reply("I'm sorry - an error occurred and "
+                                      "I coudn't commit your skirmish.  "
+                                      "Disregard the previous confirmation")
                     return
             else:
                 # Update the top-level summary
                 SkirmishCommand.update_summary(context, skirmish)
 
-            context.session.commit()
+            context.session.checkpoint()
 
         except db.NotPresentException as npe:
             standard = (("Your armies are currently in %s and thus cannot "
@@ -501,7 +684,7 @@ class SkirmishCommand(Command):
             else:
                 context.reply("The battle has not yet begun!")
 
-    @failable
+    @retried
     def extract_subskirmish(self, context, battle):
         if not context.comment.author:
             return None
@@ -509,7 +692,11 @@ class SkirmishCommand(Command):
         # If we've already processed the parent, it wasn't us
         # (we bail out if we see ourself as author before marking as processed)
         pid = context.comment.parent_id
-        found = context.session.query(Processed).filter_by(id36=pid).count()
+        if context.seen is not None:
+            found = pid in context.seen
+        else:
+            found = context.session.query(Processed).filter_by(
+                id36=pid).count()
         if found:
             return None
 
@@ -526,7 +713,9 @@ class SkirmishCommand(Command):
             # Record this in our processed list so we don't have to do this
             # again.
             context.session.add(Processed(id36=parent.name, battle=battle))
-            context.session.commit()
+            context.session.checkpoint()
+            if context.seen is not None:
+                context.seen.add(parent.name)
             return None
 
         regex = re.compile(r"\(subskirmish (\d+)\)")
@@ -553,6 +742,9 @@ class SkirmishCommand(Command):
 
     @staticmethod
     def update_summary(context, skirmish):
+        if context.summaries is not None:
+            context.summaries.mark(skirmish)
+            return
         root = skirmish.get_root()
         if root.summary_id:
             tls = context.reddit.get_info(
@@ -561,6 +753,76 @@ class SkirmishCommand(Command):
             tls.edit(text)
 
 
+class SimulateCommand(Command):
+    """What would happen to a skirmish if..."""
+
+    def __init__(self, tokens):
+        self.action = None
+        if 'action' in tokens:
+            self.action = tokens['action']
+            if self.action == 'oppose':
+                self.action = 'attack'
+        self.target = int(tokens['target'])
+        self.amount = int(tokens['amount'])
+        self.troop_type = 'infantry'
+        if 'troop_type' in tokens:
+            self.troop_type = SkirmishCommand.ALIASES.get(tokens['troop_type'],
+                                                          tokens['troop_type'])
+
+    def execute(self, context):
+        if not simulation.available():
+            context.reply("Sorry, simulations aren't available right now")
+            return
+
+        skirmish = context.session.query(SkirmishAction).filter_by(
+            id=self.target).first()
+        if not skirmish:
+            context.reply("That does not appear to be a valid skirmish!")
+            return
+        if self.amount <= 0:
+            context.reply("You must use at least 1 troop!")
+            return
+
+        root = skirmish.get_root()
+        sim = simulation.Simulation(
+            skirmish.get_battle().scoreboard().nodes.values(), root.id)
+        if self.action:
+            troop_type = context.player.translate_codeword(self.troop_type)
+            if troop_type not in SkirmishAction.TROOP_TYPES:
+                troop_type = 'infantry'
+            before, after = sim.what_if(skirmish.id,
+                                        self.action == 'attack',
+                                        self.amount, troop_type)
+            context.reply(("As it stands, **Skirmish #%d** goes to %s\n\n"
+                           "If %d more %s were to %s #%d, it would go to %s")
+                          % (root.id, self.outcome(before, context.config),
+                             self.amount, troop_type, self.action,
+                             skirmish.id,
+                             self.outcome(after, context.config)))
+        else:
+            trials = context.config["game"].get("simulations", 1000)
+            if trials <= 0:
+                context.reply("Sorry, simulations aren't available right now")
+                return
+            won, tied, lost = sim.sample(context.player.team, self.amount,
+                                         trials)
+            context.reply(("Against %d random enemy responses of up to %d "
+                           "troops, **Skirmish #%d** is won by the %s %d%% of "
+                           "the time, tied %d%% and lost %d%%") %
+                          (trials, self.amount, root.id, context.team_name(),
+                           100 * won / trials, 100 * tied / trials,
+                           100 * lost / trials))
+
+    @staticmethod
+    def outcome(result, config):
+        """Like SkirmishAction.winner_str, for a (victor, margin, vp)"""
+        victor, margin, vp = result
+        if victor is None:
+            return "**TIE**"
+        return ("**%s** by %d for **%d VP**" %
+                (num_to_team(victor, config), margin, vp))
+
+
 class TimeCommand(Command):
 
     def execute(self, context):
@@ -1,15 +1,24 @@
 import json
 import logging
 import time
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import chain
 
 from sqlalchemy import (
-    create_engine, Boolean, Column, ForeignKey, Integer, String, Table)
+    and_, bindparam, case, create_engine, event, literal, or_, select,
+    Boolean, Column, ForeignKey, Index, Integer, String, Table)
 from sqlalchemy.orm import backref, relationship, sessionmaker
+from sqlalchemy.orm.attributes import get_history, set_committed_value
 from sqlalchemy.orm.session import Session
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.hybrid import Comparator, hybrid_property
 
+import resolver
 import utils
-from utils import name_to_id, now, num_to_team
+from atlas import Atlas
+from utils import name_to_id, name_to_pair, now, num_to_team, pair_to_name
 
 
 # Some helpful model exceptions
@@ -81,10 +90,192 @@ class Model(object):
 Base = declarative_base(cls=Model)
 
 
+class FullnameComparator(Comparator):
+    """Lets queries compare a fullname() against a plain reddit name"""
+    def __init__(self, kind, num):
+        Comparator.__init__(self, num)
+        self.kind = kind
+        self.num = num
+
+    def __eq__(self, other):
+        kind, num = name_to_pair(other)
+        return and_(self.kind == kind, self.num == num)
+
+    def __ne__(self, other):
+        kind, num = name_to_pair(other)
+        return ~and_(self.kind == kind, self.num == num)
+
+
+def fullname(kind_attr, num_attr):
+    """
+    Reddit names like t1_xxxx are stored as a pair of integer columns (the
+    kind and the base36 id); this presents the pair as the usual string, both
+    on instances and in filter_by()
+    """
+    def fget(self):
+        return pair_to_name(getattr(self, kind_attr), getattr(self, num_attr))
+
+    def fset(self, value):
+        kind, num = name_to_pair(value)
+        setattr(self, kind_attr, kind)
+        setattr(self, num_attr, num)
+
+    def comparator(cls):
+        return FullnameComparator(getattr(cls, kind_attr),
+                                  getattr(cls, num_attr))
+
+    return hybrid_property(fget, fset).comparator(comparator)
+
+
+class ChromaSession(Session):
+    """
+    A session that can batch a whole frame's worth of work into one
+    transaction.  Model code calls checkpoint() rather than commit();
+    inside unit_of_work() or a savepoint() that only flushes, and the
+    frame commits once at the end.
+    """
+
+    deferred = False
+    # The map as an Atlas, built when first needed
+    _atlas = None
+
+    def __init__(self, *args, **kwargs):
+        # What to do if each transaction in progress is rolled back,
+        # innermost last (see on_rollback)
+        self._undo = []
+        # How deep the transaction being committed is
+        self._committed = None
+        Session.__init__(self, *args, **kwargs)
+
+    def atlas(self):
+        """The map, without querying it each time (see atlas.Atlas)"""
+        if self.autoflush:
+            self.flush()
+        if self._atlas is None:
+            regions = self.query(Region.id, Region.name, Region.srname,
+                                 Region.owner)
+            borders = self.execute(select([region_to_region.c.left_id,
+                                           region_to_region.c.right_id]))
+            self._atlas = Atlas(regions, borders)
+        return self._atlas
+
+    def forget_atlas(self):
+        self._atlas = None
+
+    def on_rollback(self, undo):
+        """
+        Call undo if what's been done so far in the current transaction is
+        rolled back, whether by a rollback of this transaction or of one
+        it's part of.  Lets anything kept in memory alongside the database
+        forget only what a rollback actually took away.
+        """
+        self._undo[-1].append(undo)
+
+    def checkpoint(self):
+        if self.deferred or self.transaction.nested:
+            self.flush()
+        else:
+            self.commit()
+
+    @contextmanager
+    def savepoint(self):
+        """
+        Isolate a block (usually one command) so that a rollback(), or an
+        exception escaping it, only undoes that block
+        """
+        txn = self.begin_nested()
+        try:
+            yield txn
+        except:
+            if txn.is_active:
+                txn.rollback()
+            raise
+        if txn.is_active:
+            txn.commit()
+
+    @contextmanager
+    def unit_of_work(self):
+        """Run everything in the block as a single transaction"""
+        self.deferred = True
+        try:
+            yield self
+            self.deferred = False
+            self.commit()
+        except:
+            self.deferred = False
+            self.rollback()
+            raise
+
+
+@event.listens_for(ChromaSession, "after_transaction_create")
+def begin_undo(session, transaction):
+    session._undo.append([])
+
+
+@event.listens_for(ChromaSession, "after_commit")
+def mark_committed(session):
+    session._committed = len(session._undo)
+
+
+@event.listens_for(ChromaSession, "after_transaction_end")
+def end_undo(session, transaction):
+    undo = session._undo.pop()
+    if session._undo and not transaction.nested:
+        # Flushes run in a subtransaction of the real one, which settles
+        # what happens to anything done in them
+        session._undo[-1].extend(undo)
+    elif session._committed == len(session._undo) + 1:
+        session._committed = None
+        if session._undo:
+            # A savepoint's work now stands or falls with the one around it
+            session._undo[-1].extend(undo)
+    else:
+        for each in reversed(undo):
+            each()
+
+
+@event.listens_for(ChromaSession, "after_flush")
+def redraw_map(session, flush_context):
+    redrawn = False
+    for obj in chain(session.new, session.deleted):
+        if isinstance(obj, Region):
+            session._atlas = None
+            redrawn = True
+    for obj in session.dirty:
+        if isinstance(obj, Region):
+            changed = [attr for attr in Region.MAPPED
+                       if get_history(obj, attr).has_changes()]
+            if not changed:
+                continue
+            redrawn = True
+            if session._atlas is None:
+                continue
+            if changed == ['owner']:
+                # Regions changing hands is the usual case, and cheap to
+                # follow
+                session._atlas.transfer(obj.id, obj.owner)
+            else:
+                session._atlas = None
+    if redrawn:
+        # Only a rollback of this means the map has to be read again
+        session.on_rollback(session.forget_atlas)
+
+
 class DB(object):
     def __init__(self, config):
         self.engine = create_engine(config.dbstring, echo=False)
-        self.sessionfactory = sessionmaker(bind=self.engine)
+        if self.engine.url.drivername.startswith("sqlite"):
+            # pysqlite's own transaction handling breaks SAVEPOINT, so take
+            # over issuing BEGIN ourselves
+            @event.listens_for(self.engine, "connect")
+            def do_connect(dbapi_connection, connection_record):
+                dbapi_connection.isolation_level = None
+
+            @event.listens_for(self.engine, "begin")
+            def do_begin(conn):
+                conn.execute("BEGIN")
+        self.sessionfactory = sessionmaker(bind=self.engine,
+                                           class_=ChromaSession)
 
     def create_all(self):
         Base.metadata.create_all(self.engine)
@@ -100,7 +291,7 @@ class User(Base):
     __tablename__ = 'users'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(255))
+    name = Column(String(255), index=True)
     team = Column(Integer)
     loyalists = Column(Integer)
     committed_loyalists = Column(Integer, default=0)
@@ -131,7 +322,7 @@ class User(Base):
             cw = CodeWord(code=code, word=word)
             self.codewords.append(cw)
             s.add(cw)
-        s.commit()
+        s.checkpoint()
 
     def defect(self, team):
         if team == self.team or team > 1:
@@ -142,7 +333,7 @@ class User(Base):
 
         self.team = team
         self.region = Region.capital_for(team, self.session())
-        self.session().commit()
+        self.session().checkpoint()
 
     def is_moving(self):
         if self.movement:
@@ -167,7 +358,8 @@ class User(Base):
             raise InsufficientException(how_many, self.loyalists, "loyalists")
 
         # TODO: Drop off loyalists
-        if not where in self.region.borders:
+        route = sess.atlas().route(self.team, self.region.id, where.id)
+        if not route:
             raise NonAdjacentException(self.region, where)
 
         if where.owner != self.team:
@@ -175,17 +367,20 @@ class User(Base):
                 raise TeamException(where)
 
         if(delay > 0):
+            # delay is per region passed through
             result = MarchingOrder(arrival=time.mktime(time.localtime())
                                     + delay,
                                    leader=self,
                                    source=self.region,
-                                   dest=where)
+                                   dest=where,
+                                   leg=delay)
+            result.set_route(route)
             sess.add(result)
         else:
             self.region = where
         # TODO: Change number of loyalists
         self.defectable = False
-        sess.commit()
+        sess.checkpoint()
 
         return result
 
@@ -194,7 +389,7 @@ class User(Base):
         cw = s.query(CodeWord).filter_by(code=code, user=self).first()
         if cw:
             s.delete(cw)
-            s.commit()
+            s.checkpoint()
 
     def translate_codeword(self, code):
         code = code.strip().lower()
@@ -214,22 +409,48 @@ class MarchingOrder(Base):
     __tablename__ = "marching_orders"
 
     id = Column(Integer, primary_key=True)
-    arrival = Column(Integer, default=0)
+    arrival = Column(Integer, default=0, index=True)
 
-    leader_id = Column(Integer, ForeignKey('users.id'))
+    leader_id = Column(Integer, ForeignKey('users.id'), index=True)
     leader = relationship("User", backref="movement")
 
     # Relationships for these defined in the Region class
     source_id = Column(Integer, ForeignKey("regions.id"))
     dest_id = Column(Integer, ForeignKey("regions.id"))
 
+    # For marches through several regions: the ids of the ones still to
+    # reach, comma separated, ending with dest_id.  source_id is where the
+    # leg in progress began, and arrival when it ends; each leg takes leg
+    # seconds.
+    route = Column(String)
+    leg = Column(Integer, default=0)
+
     @classmethod
-    def update_all(cls, sess):
-        orders = sess.query(cls).all()
-        result = []
+    def update_all(cls, sess, orders=None):
+        """
+        Move everyone who has reached the next region on their way.  Checks
+        every order that's due unless given a list of the ones to look at.
+        Returns the orders whose marches are now over (having arrived, or
+        been halted on the way), and those that have finished a leg but
+        still have further to go.
+        """
+        if orders is None:
+            orders = sess.query(cls).filter(cls.arrival <= now()).all()
+        arrived = []
+        underway = []
         for order in orders:
-            if order.update():
-                result.append(order)
+            if order.update(autocommit=False):
+                if order in sess.deleted:
+                    arrived.append(order)
+                else:
+                    underway.append(order)
+        if arrived or underway:
+            sess.checkpoint()
+
+        result = {
+            "arrived": arrived,
+            "underway": underway
+        }
         return result
 
     def has_arrived(self):
@@ -237,31 +458,67 @@ class MarchingOrder(Base):
         return self.arrival <= now
 
     def arrival_str(self):
-        return self.timestr(self.arrival)
+        return self.timestr(self.final_arrival())
+
+    def final_arrival(self):
+        """When the last leg ends, rather than the one in progress"""
+        return self.arrival + (self.leg or 0) * (len(self.hops()) - 1)
+
+    def hops(self):
+        """Ids of the regions still to reach, in order"""
+        if not self.route:
+            return [self.dest_id]
+        return [int(rid) for rid in self.route.split(",")]
+
+    def set_route(self, route):
+        self.route = ",".join(str(rid) for rid in route)
 
     def set_complete(self):
         self.arrival = now()
 
-    def update(self):
+    def update(self, autocommit=True):
+        """
+        Move the leader along if they've reached the next region on the
+        way, as many legs as have passed.  Marches that are finished, or
+        can't go on because the way ahead is no longer friendly, end.
+        Returns whether the leader moved at all.
+        """
         sess = Session.object_session(self)
-        if self.has_arrived():
-            self.leader.region = self.dest
-            sess.delete(self)
-            sess.commit()
-            return True
-        return False
+        if not self.has_arrived():
+            return False
+        hops = self.hops()
+        while self.has_arrived():
+            here = sess.query(Region).get(hops.pop(0))
+            self.leader.region = here
+            ahead = sess.query(Region).get(hops[0]) if hops else None
+            if ahead and ahead.owner != self.leader.team and not ahead.battle:
+                logging.info("%s halted at %s, %s is hostile" %
+                             (self.leader.name, here.name, ahead.name))
+                ahead = None
+            if not ahead:
+                sess.delete(self)
+                break
+            self.source = here
+            self.set_route(hops)
+            self.arrival += self.leg
+        if autocommit:
+            sess.checkpoint()
+        return True
 
 
 class Region(Base):
     __tablename__ = "regions"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(255))
-    srname = Column(String(255))
-    capital = Column(Integer)
+    name = Column(String(255), index=True)
+    srname = Column(String(255), index=True)
+    capital = Column(Integer, index=True)
     owner = Column(Integer)
     eternal = Column(Boolean)
 
+    # Changes to these mean the session's Atlas is out of date
+    MAPPED = ('name', 'srname', 'owner', 'borders', 'other_borders')
+
     people = relationship("User", backref="region")
 
     borders = relationship("Region", secondary=region_to_region,
@@ -353,10 +610,8 @@ class Region(Base):
 
         # Make sure that the given team owns at least one region adjacent
         # to this one
-        bad_neighbors = [region for region in self.borders
-                         if region.owner is not None
-                            and region.owner == by_who.team]
-        if not bad_neighbors:
+        sess = Session.object_session(self)
+        if self.id not in sess.atlas().frontier[by_who.team]:
             raise NonAdjacentException(self, "your territory")
 
         by_who.defectable = False
@@ -370,7 +625,7 @@ class Region(Base):
             )
         if autocommit:
             sess.add(battle)
-            sess.commit()
+            sess.checkpoint()
         return battle
 
     def markdown(self):
@@ -384,9 +639,11 @@ class Battle(Base):
     __tablename__ = "battles"
 
     id = Column(Integer, primary_key=True)
-    begins = Column(Integer, default=0)
-    ends = Column(Integer, default=0)
-    submission_id = Column(String)
+    begins = Column(Integer, default=0, index=True)
+    ends = Column(Integer, default=0, index=True)
+    submission_kind = Column(Integer)
+    submission_num = Column(Integer, index=True)
+    submission_id = fullname('submission_kind', 'submission_num')
 
     victor = Column(Integer)
     score0 = Column(Integer)
@@ -397,17 +654,29 @@ class Battle(Base):
 
     lockout = Column(Integer, default=0)
 
+    # High-water mark for comment ingestion: the newest comment we've seen
+    # in this battle's thread
+    high_water_name = Column(String)
+    high_water_time = Column(Integer, default=0)
+
     @classmethod
-    def update_all(cls, sess):
-        battles = sess.query(cls).all()
+    def update_all(cls, sess, battles=None):
+        """
+        Find battles that are ready to begin, and resolve the ones that are
+        over.  Checks every battle that might be either unless given a list
+        of the ones to look at.
+        """
+        if battles is None:
+            battles = sess.query(cls).filter(cls.due(now())).all()
         begin = []
         ended = []
         for battle in battles:
             if not battle.has_started() and battle.is_ready():
                 begin.append(battle)
             elif battle.has_started() and battle.past_end_time():
-                battle.resolve()
                 ended.append(battle)
+        if ended:
+            cls.resolve_all(sess, ended)
 
         result = {
             "begin": begin,
@@ -415,6 +684,16 @@ class Battle(Base):
         }
         return result
 
+    @classmethod
+    def due(cls, when):
+        """
+        SQL version of the checks in update_all: battles that are ready
+        and either haven't started or are past their end time
+        """
+        not_started = or_(cls.submission_num == None, cls.ends < cls.begins)
+        return and_(cls.begins <= when,
+                    or_(not_started, cls.ends <= when))
+
     def begins_str(self):
         return self.timestr(self.begins)
 
@@ -425,7 +704,7 @@ class Battle(Base):
         sess = self.session()
         sa = SkirmishAction.create(sess, who, howmany, battle=self,
                                    troop_type=troop_type)
-        sess.commit()
+        sess.checkpoint()
         return sa
 
     def has_started(self):
@@ -452,6 +731,13 @@ class Battle(Base):
     def participants(self):
         return {skirmish.participant for skirmish in self.skirmishes}
 
+    def mark_seen(self, comment):
+        """Advance the high-water mark if comment is newer than it"""
+        created = int(comment.created_utc)
+        if created >= (self.high_water_time or 0):
+            self.high_water_time = created
+            self.high_water_name = comment.name
+
     def past_end_time(self):
         now = time.mktime(time.localtime())
         return now >= self.ends
@@ -464,11 +750,47 @@ class Battle(Base):
         return result
 
     def resolve(self):
+        self.resolve_all(self.session(), [self])
+
+    @classmethod
+    def load_nodes(cls, sess, battles):
+        """
+        Every skirmish in the given battles, loaded in one query as
+        resolver.Nodes.  Returns a dict of battle id -> list of nodes.
+        """
+        sess.flush()
+        rows = (sess.query(SkirmishAction.battle_id, SkirmishAction.id,
+                           SkirmishAction.parent_id, User.team,
+                           SkirmishAction.amount, SkirmishAction.hinder,
+                           SkirmishAction.troop_type).
+                join(SkirmishAction.participant).
+                filter(SkirmishAction.battle_id.in_([b.id for b in battles])))
+        by_battle = defaultdict(list)
+        for row in rows:
+            by_battle[row[0]].append(resolver.Node(*row[1:]))
+        return by_battle
+
+    @classmethod
+    def resolve_all(cls, sess, battles):
+        """
+        Resolve several battles at once: every skirmish in all of them is
+        loaded in one query and resolved as a single batch
+        """
+        by_battle = cls.load_nodes(sess, battles)
+        nodes = [node for battle in battles for node in by_battle[battle.id]]
+        resolver.resolve_batch(nodes)
+        SkirmishAction.store_results(sess, nodes)
+
+        for battle in battles:
+            battle.conclude(by_battle[battle.id])
+        sess.checkpoint()
+
+    def conclude(self, nodes):
+        """Score this battle from its resolved skirmishes and apply it"""
         score = [0, 0]
-        for skirmish in self.toplevel_skirmishes():
-            skirmish.resolve()
-            if skirmish.victor is not None:
-                score[skirmish.victor] += skirmish.vp
+        for node in nodes:
+            if node.is_root and node.victor is not None:
+                score[node.victor] += node.vp
         self.score0, self.score1 = score
 
         if self.score0 > self.score1:
@@ -493,13 +815,96 @@ class Battle(Base):
                     losercap = Region.capital_for(person.team,
                                                   self.session())
                 person.region = losercap
-            self.session().commit()
 
-        self.session().commit()
+    def scoreboard(self):
+        """
+        Live standings for this battle.  Built from the database the first
+        time it's needed, then kept up to date by scored() as skirmishes
+        come in - unless a rollback takes back something it counted, in
+        which case it's built afresh.
+        """
+        board = getattr(self, '_scoreboard', None)
+        if board is None:
+            sess = self.session()
+            nodes = self.load_nodes(sess, [self])[self.id]
+            board = resolver.Scoreboard(nodes)
+            self._scoreboard = board
+            # It counts whatever's been flushed in this transaction
+            sess.on_rollback(self.forget_scoreboard)
+        return board
+
+    def scored(self, skirmish):
+        """Bring the scoreboard, if we have one, up to date with skirmish"""
+        board = getattr(self, '_scoreboard', None)
+        if board is None:
+            return
+        board.add(resolver.Node(skirmish.id, skirmish.parent_id,
+                                skirmish.participant.team, skirmish.amount,
+                                skirmish.hinder, skirmish.troop_type))
+        self.session().on_rollback(self.forget_scoreboard)
+
+    def forget_scoreboard(self):
+        self._scoreboard = None
+
+    def standings(self, config=None):
+        """The live score, e.g. 'Orangered 16, Periwinkle 30'"""
+        score = self.scoreboard().score
+        return ", ".join("%s %d" % (num_to_team(team, config), score[team])
+                         for team in (0, 1))
 
     def set_complete(self):
         self.ends = now()
 
+    def archive(self):
+        """
+        Copy this battle and its skirmish tree into the archive tables.  The
+        skirmishes go across in a single INSERT ... SELECT.
+        """
+        sess = self.session()
+        sess.flush()
+        archived = ArchivedBattle(battle_id=self.id,
+                                  region_id=self.region_id,
+                                  begins=self.begins,
+                                  ends=self.ends,
+                                  submission_kind=self.submission_kind,
+                                  submission_num=self.submission_num,
+                                  victor=self.victor,
+                                  score0=self.score0,
+                                  score1=self.score1)
+        sess.add(archived)
+        sess.flush()
+
+        live = SkirmishAction.__table__
+        troop = case([(live.c.troop_type == name, i) for i, name
+                      in enumerate(SkirmishAction.TROOP_TYPES)], else_=0)
+        copied = select([literal(archived.id), live.c.id, live.c.parent_id,
+                         live.c.participant_id, live.c.amount, live.c.hinder,
+                         troop, live.c.victor, live.c.vp, live.c.margin,
+                         live.c.unopposed, live.c.comment_kind,
+                         live.c.comment_num]).where(
+                             live.c.battle_id == self.id)
+        names = ['archive_id', 'skirmish_id', 'parent_id', 'participant_id',
+                 'amount', 'hinder', 'troop', 'victor', 'vp', 'margin',
+                 'unopposed', 'comment_kind', 'comment_num']
+        sess.execute(ArchivedSkirmish.__table__.insert().from_select(names,
+                                                                     copied))
+        return archived
+
+    def teardown(self):
+        """
+        Archive this battle, then delete it along with its skirmishes and
+        processed comments.  The children go in one DELETE apiece rather
+        than letting the ORM cascade load and delete them one at a time.
+        """
+        self.archive()
+        sess = self.session()
+        for cls in (Processed, SkirmishAction):
+            (sess.query(cls).filter(cls.battle_id == self.id).
+             delete(synchronize_session='fetch'))
+        # Nothing is left for the cascade to find, so these load empty
+        sess.expire(self, ['skirmishes', 'processed_comments'])
+        sess.delete(self)
+
     def toplevel_skirmishes(self):
         return [s for s in self.skirmishes if s.parent is None]
 
@@ -509,6 +914,7 @@ class Battle(Base):
 
 class CodeWord(Base):
     __tablename__ = 'codewords'
+    __table_args__ = (Index('ix_codewords_user_id_code', 'user_id', 'code'),)
 
     id = Column(Integer, primary_key=True)
     code = Column(String(255))
@@ -522,26 +928,124 @@ class CodeWord(Base):
                                                      self.word.encode('utf-8'))
 
 
+class ArchivedBattle(Base):
+    """A finished battle, kept once it's gone from the live tables"""
+    __tablename__ = "archived_battles"
+
+    id = Column(Integer, primary_key=True)
+    battle_id = Column(Integer)  # What its id was while it was live
+    begins = Column(Integer)
+    ends = Column(Integer)
+    submission_kind = Column(Integer)
+    submission_num = Column(Integer)
+    submission_id = fullname('submission_kind', 'submission_num')
+
+    victor = Column(Integer)
+    score0 = Column(Integer)
+    score1 = Column(Integer)
+
+    region_id = Column(Integer, ForeignKey('regions.id'))
+    region = relationship("Region")
+
+    def __repr__(self):
+        return "<ArchivedBattle(id='%s', region='%s'>" % (self.id,
+                                                          self.region)
+
+
+class ArchivedSkirmish(Base):
+    """
+    A resolved SkirmishAction from an archived battle.  Ids are the ones the
+    skirmishes had while live, and troop types are stored as their index in
+    SkirmishAction.TROOP_TYPES.
+    """
+    __tablename__ = "archived_skirmishes"
+
+    id = Column(Integer, primary_key=True)
+    archive_id = Column(Integer, ForeignKey('archived_battles.id'),
+                        index=True)
+    battle = relationship("ArchivedBattle", backref="skirmishes")
+
+    skirmish_id = Column(Integer)
+    parent_id = Column(Integer)
+    participant_id = Column(Integer, ForeignKey('users.id'))
+    participant = relationship("User")
+
+    amount = Column(Integer)
+    hinder = Column(Boolean)
+    troop = Column(Integer)
+    comment_kind = Column(Integer)
+    comment_num = Column(Integer)
+    comment_id = fullname('comment_kind', 'comment_num')
+
+    victor = Column(Integer)
+    vp = Column(Integer)
+    margin = Column(Integer)
+    unopposed = Column(Boolean)
+
+    @property
+    def troop_type(self):
+        return SkirmishAction.TROOP_TYPES[self.troop]
+
+
 class Processed(Base):
     __tablename__ = "processed"
 
     id = Column(Integer, primary_key=True)
-    id36 = Column(String)
+    id36_kind = Column(Integer)
+    id36_num = Column(Integer, index=True)
+    id36 = fullname('id36_kind', 'id36_num')
 
-    battle_id = Column(Integer, ForeignKey('battles.id'))
+    battle_id = Column(Integer, ForeignKey('battles.id'), index=True)
     battle = relationship("Battle",
                           backref=backref("processed_comments",
                                           cascade="all, delete"))
 
 
+class Outgoing(Base):
+    """
+    Something we're going to say to reddit (see outbound.Outbound).  Saved
+    in the same transaction as whatever prompted it, so it's neither lost
+    if we crash before sending it nor sent for changes that rolled back.
+    """
+    __tablename__ = "outbox"
+
+    # Safe to send twice; anything else is only ever tried once if we can't
+    # tell whether it went through
+    IDEMPOTENT = ['edit', 'settings']
+
+    id = Column(Integer, primary_key=True)
+    # Hash of the content, so the same message can't be queued twice
+    key = Column(String(40), unique=True)
+    priority = Column(Integer, default=0)
+    state = Column(String(8), default='queued', index=True)
+    kind = Column(String(8))        # pm, reply, edit or settings
+    target = Column(String)         # username, fullname or subreddit
+    subject = Column(String)
+    body = Column(String)
+    created = Column(Integer, default=now)
+    attempts = Column(Integer, default=0)
+
+    @property
+    def idempotent(self):
+        return self.kind in self.IDEMPOTENT
+
+    def __repr__(self):
+        return "<Outgoing(id=%s, kind='%s', target='%s', state='%s')>" % (
+            self.id, self.kind, self.target, self.state)
+
+
 class SkirmishAction(Base):
     __tablename__ = "skirmish_actions"
 
     TROOP_TYPES = ['infantry', 'cavalry', 'ranged']
 
     id = Column(Integer, primary_key=True)
-    comment_id = Column(String)
-    summary_id = Column(String)
+    comment_kind = Column(Integer)
+    comment_num = Column(Integer, index=True)
+    comment_id = fullname('comment_kind', 'comment_num')
+    summary_kind = Column(Integer)
+    summary_num = Column(Integer)
+    summary_id = fullname('summary_kind', 'summary_num')
     amount = Column(Integer, default=0)
     hinder = Column(Boolean, default=True)
     troop_type = Column(String, default='infantry')
@@ -551,19 +1055,26 @@ class SkirmishAction(Base):
     margin = Column(Integer)
     unopposed = Column(Boolean, default=False)
 
-    battle_id = Column(Integer, ForeignKey('battles.id'))
+    battle_id = Column(Integer, ForeignKey('battles.id'), index=True)
     battle = relationship("Battle",
                           backref=backref("skirmishes",
                                           cascade="all, delete"))
 
-    participant_id = Column(Integer, ForeignKey('users.id'))
+    participant_id = Column(Integer, ForeignKey('users.id'), index=True)
     participant = relationship("User", backref="skirmishes")
 
-    parent_id = Column(Integer, ForeignKey('skirmish_actions.id'))
-    children = relationship("SkirmishAction",
+    parent_id = Column(Integer, ForeignKey('skirmish_actions.id'),
+                       index=True)
+    children = relationship("SkirmishAction", foreign_keys=[parent_id],
         backref=backref('parent', remote_side=[id],
                         cascade="all, delete"))
 
+    # Denormalized so finding the top of a long reply chain doesn't mean
+    # walking up it: the root's id (its own, for a root) and how far down
+    # from it this is
+    root_id = Column(Integer, ForeignKey('skirmish_actions.id'), index=True)
+    depth = Column(Integer, default=0)
+
     @classmethod
     def create(cls, sess, who, howmany, hinder=True, parent=None, battle=None,
                troop_type='infantry'):
@@ -572,50 +1083,51 @@ class SkirmishAction(Base):
         if troop_type not in cls.TROOP_TYPES:
             troop_type = 'infantry'
 
-        sa = SkirmishAction(participant=who,
-                            amount=howmany,
-                            hinder=hinder,
-                            parent=parent,
-                            battle=battle,
-                            troop_type=troop_type)
-        sa.commit_if_valid()
-
+        root_id = None
+        depth = 0
+        if parent:
+            root_id = parent.get_root().id
+            depth = (parent.depth or 0) + 1
+
+        # Building the action attaches it to the session via its
+        # relationships, so a rejected one needs undoing - but only it, and
+        # not everything else the session has loaded
+        with sess.savepoint():
+            sa = SkirmishAction(participant=who,
+                                amount=howmany,
+                                hinder=hinder,
+                                parent=parent,
+                                battle=battle,
+                                troop_type=troop_type,
+                                root_id=root_id,
+                                depth=depth)
+            sa.commit_if_valid()
+        if sa.root_id is None:
+            sa.root_id = sa.id
+
+        sa.get_battle().scored(sa)
         return sa
 
     def adjusted_for_type(self, other_type, amount, support=False):
         """Certain types will be more effective vs. this skirmish"""
-        if support:
-            ordering = ["cavalry", "infantry", "ranged"]
-        else:
-            ordering = ["ranged", "infantry", "cavalry"]
-        our_index = ordering.index(self.troop_type)
-        penalty = ordering[our_index - 1]
-        bonus = ordering[(our_index + 1) % len(ordering)]
-        result = amount
-        if other_type == penalty:
-            result = int(amount / 2)
-        elif other_type == bonus:
-            result = int(amount * 1.5)
-        return result
+        return resolver.adjusted_for_type(self.troop_type, other_type, amount,
+                                          support)
 
     def get_battle(self):
         """
         Returns the battle that this skirmish belongs to - if this is a
-        child skirmish, will go up the chain to the root
+        child skirmish, that of its root
         """
-        if self.parent:
-            return self.get_root().get_battle()
-        else:
-            return self.battle
+        return self.get_root().battle
 
     def get_root(self):
         """
         Returns the root of this skirmish, which may be itself
         """
-        if self.parent:
-            return self.parent.get_root()
-        else:
+        if self.root_id is None or self.root_id == self.id:
             return self
+        # Usually already in the identity map, so no query at all
+        return self.session().query(SkirmishAction).get(self.root_id)
 
     @property
     def is_root(self):
@@ -625,71 +1137,55 @@ class SkirmishAction(Base):
         sess = self.session()
         sa = SkirmishAction.create(sess, who, howmany, hinder, parent=self,
                                    troop_type=troop_type, battle=self.battle)
-
+        sess.checkpoint()
         return sa
 
     def resolve(self):
-        # Make a results representing us
-        self.victor = self.participant.team
-        self.vp = 0
-        self.margin = self.amount
-        self.unopposed = True
-
-        # Resolve our children, if any
-        if self.children:
-            supporters = [child.resolve() for child in self.children
-                          if child.hinder == False]
-            support = self.amount
-            raw_support = support
-            attack = 0
-            raw_attack = attack
-            for supporter in supporters:
-                self.vp += supporter.vp
-                if supporter.victor == self.participant.team:
-                    # Support only counts if it didn't get ambushed on the way
-                    amount = supporter.margin
-                    raw_support += amount
-                    support += self.adjusted_for_type(supporter.troop_type,
-                                                      amount,
-                                                      support=True)
-                # If the attackers overtook this support, we do nothing;
-                # attacks don't carry beyond their immediate target
-
-            attackers = [child.resolve() for child in self.children
-                         if child.hinder == True]
-            for attacker in attackers:
-                self.vp += attacker.vp
-                if attacker.victor != self.participant.team:
-                    # Attackers only count if they weren't beaten by our team
-                    amount = attacker.margin
-                    raw_attack += amount
-                    attack += self.adjusted_for_type(attacker.troop_type,
-                                                     amount)
-
-            self.unopposed = attack == 0
-
-            if(attack > support):
-                # This skirmish loses!
-                self.margin = attack - support
-                self.victor = [1, 0][self.participant.team]
-                self.vp += raw_support
-            elif(support > attack):
-                # This skirmish wins!
-                self.margin = support - attack
-                self.victor = self.participant.team
-                self.vp += raw_attack
-            else:
-                # Nobody is the winner, but this skirmish is sure the loser
-                self.victor = None
-                self.margin = 0
-                self.vp += max(raw_attack, raw_support)
-        # Unopposed root nodes are worth 2x VP
-        if not self.parent and self.unopposed:
-            self.vp = max(self.vp * 2, self.amount * 2)
-
-        self.session().commit()
+        """Resolve this skirmish and everything under it"""
+        # Gather the subtree without recursing, then resolve it in one go
+        actions = []
+        pending = [self]
+        while pending:
+            action = pending.pop()
+            actions.append(action)
+            pending.extend(action.children)
+        nodes = [resolver.Node(a.id, a.parent_id, a.participant.team,
+                               a.amount, a.hinder, a.troop_type)
+                 for a in actions]
+        resolver.resolve_forest(nodes)
+
+        for action, node in zip(actions, nodes):
+            for attr in resolver.Node.RESULTS:
+                setattr(action, attr, getattr(node, attr))
+        self.session().checkpoint()
         return self
 
+    @classmethod
+    def store_results(cls, sess, nodes):
+        """
+        Write resolved nodes back in one executemany UPDATE, and bring any
+        of the skirmishes we already have loaded up to date to match
+        """
+        if not nodes:
+            return
+        table = cls.__table__
+        stmt = table.update().where(table.c.id == bindparam('_id')).values(
+            dict((attr, bindparam('_' + attr))
+                 for attr in resolver.Node.RESULTS))
+        params = []
+        for node in nodes:
+            param = dict(('_' + attr, value)
+                         for attr, value in node.results().items())
+            param['_id'] = node.id
+            params.append(param)
+        sess.execute(stmt, params)
+
+        for node in nodes:
+            loaded = sess.identity_map.get(identity_key(cls, node.id))
+            if loaded is not None:
+                for attr, value in node.results().items():
+                    set_committed_value(loaded, attr, value)
+
     def report(self, config=None):
         preamble = "*  Skirmish #%d - the victor is " % self.id
         postamble = self.winner_str(config)
@@ -746,30 +1242,30 @@ class SkirmishAction(Base):
         sess = self.session()
         sess.add(self)
         self.participant.defectable = False
-        sess.commit()
+        sess.checkpoint()
 
         self.participant.committed_loyalists += self.amount
 
     def validate(self):
-        """Raise exceptions if this is not a valid skirmish"""
+        """
+        Raise exceptions if this is not a valid skirmish.  Expects to be
+        run inside a savepoint, which the exception will roll back.
+        """
         sess = self.session()
 
         # This battle's actually... happening, right?
         if not self.get_battle().has_started():
-            sess.rollback()
             raise TimingException("soon")
 
         # Are we actually there?
         need_to_be = self.get_battle().region
         actually_am = self.participant.region
         if need_to_be != actually_am:
-            sess.rollback()
             raise NotPresentException(need_to_be, actually_am)
 
         if self.parent:
             sameteam = self.parent.participant.team == self.participant.team
             if self.hinder == sameteam:
-                sess.rollback()
                 raise TeamException(self, friendly=sameteam)
 
             # Can only react once to any given SkirmishAction
@@ -777,7 +1273,6 @@ class SkirmishAction(Base):
                  filter_by(parent=self.parent).
                  filter_by(participant=self.participant)).count()
             if s > 1:  # Off by one same as below
-                sess.rollback()
                 raise InProgressException(self.parent)
         else:
             # Make sure our participant doesn't have another toplevel
@@ -787,7 +1282,6 @@ class SkirmishAction(Base):
             # This is '1' and not '0' because for some damn reason that query
             # will count the newly created one
             if s > 1:
-                sess.rollback()
                 raise InProgressException(s)
 
             # If the battle has a lockout, make sure we're not past it
@@ -796,17 +1290,14 @@ class SkirmishAction(Base):
             if lockout:
                 locktime = battle.ends - lockout
                 if now() >= locktime:
-                    sess.rollback()
                     raise TimingException()
 
         requested = self.amount + self.participant.committed_loyalists
         available = self.participant.loyalists
         if requested > available:
-            sess.rollback()
             raise InsufficientException(self.amount, available, "loyalists")
 
         if self.amount <= 0:
-            sess.rollback()
             raise InsufficientException(self.amount, 1, "argument")
 
         return self
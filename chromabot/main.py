@@ -4,18 +4,23 @@ import logging
 import os.path
 import random
 import time
+import traceback
 from urllib import urlencode
 
 import praw
 from pyparsing import ParseException
 
+import breaker
+import outbound
+from authors import AuthorCache
 from config import Config
 from db import DB, Battle, Region, User, MarchingOrder, Processed
 from parser import parse
-from commands import (Command, Context, failable, InvadeCommand,
-                      SkirmishCommand, StatusCommand)
+from scheduler import Scheduler
+from commands import (Command, Context, failable, InvadeCommand, retried,
+                      StatusCommand, SummaryQueue)
 from utils import (base36decode, extract_command, num_to_team, name_to_id, now,
-                   timestr)
+                   pair_to_name, timestr)
 
 
 class Bot(object):
@@ -25,11 +30,32 @@ class Bot(object):
         self.db = DB(config)
         self.db.create_all()
         self.session = self.db.session()
+        # battle id -> set of comment names we've already processed there
+        self.seen = {}
+        self.scheduler = Scheduler(config["bot"].get("resync", 600))
+        self.scheduler.watch(self.session)
+        # Skirmish summaries to edit at the end of the frame
+        self.summaries = SummaryQueue()
+        # Everything we say to reddit, sent between frames
+        self.outbox = outbound.Outbound.from_config(self.session, reddit,
+                                                    config)
+        breaker.reddit.configure(config["bot"])
+        # Who's who among the people commenting
+        self.authors = AuthorCache(config["bot"].get("author_cache", 1000))
+        self.authors.watch(self.session)
+        # PMs handled in the frame in progress, and ones from committed
+        # frames still to be marked read
+        self.handled = []
+        self.read = []
+        # When the last frame started, for the report
+        self.last_start = None
 
     @failable
     def check_battles(self):
         session = self.session
         battles = session.query(Battle).all()
+        if self.config["bot"].get("incremental"):
+            battles = self.process_stream(battles, session)
         for battle in battles:
             post = self.reddit.get_submission(
                 comment_limit=None,
@@ -37,7 +63,7 @@ class Bot(object):
             if post:
                 self.process_post_for_battle(post, battle, session)
 
-    @failable
+    @retried
     def check_hq(self):
         hq = self.reddit.get_subreddit(self.config.headquarters)
         submissions = hq.get_new()
@@ -48,9 +74,13 @@ class Bot(object):
 
     @failable
     def check_messages(self):
-        unread = reddit.get_unread(True, True)
+        unread = self.reddit.get_unread(True, True)
         session = self.session
+        # Already done, we just couldn't tell reddit so
+        done = set(comment.name for comment in self.read)
         for comment in unread:
+            if comment.name in done:
+                continue
             # Only PMs, we deal with comment replies in process_post_for_battle
             if not comment.was_comment:
                 player = self.find_player(comment, session)
@@ -59,10 +89,21 @@ class Bot(object):
                     if not cmd:
                         cmd = comment.body
                     context = Context(player, self.config, session,
-                                      comment, self.reddit)
+                                      comment, self.reddit,
+                                      summaries=self.summaries,
+                                      outbox=self.outbox)
                     self.command(cmd, context)
 
-            comment.mark_as_read()
+            # Not marked read until the frame commits, or a rollback would
+            # lose it
+            self.handled.append(comment)
+
+    @failable
+    def mark_read(self):
+        """Tell reddit about PMs from committed frames"""
+        while self.read:
+            self.read[0].mark_as_read()
+            self.read.pop(0)
 
     def command(self, text, context):
         text = text.lower()
@@ -70,7 +111,9 @@ class Bot(object):
                      (text, context.player.name))
         try:
             parsed = parse(text)
-            parsed.execute(context)
+            # A command that fails only takes its own changes down with it
+            with context.session.savepoint():
+                parsed.execute(context)
         except ParseException as pe:
             result = (
                 "I'm sorry, I couldn't understand your command:"
@@ -81,11 +124,14 @@ class Bot(object):
             context.reply(result)
 
     def find_player(self, comment, session):
-        player = session.query(User).filter_by(
-        name=comment.author.name).first()
-        if not player and getattr(comment, 'was_comment', None):
-            comment.reply(Command.FAIL_NOT_PLAYER %
-                              self.config.headquarters)
+        name = comment.author.name
+        player = self.authors.find(session, name)
+        # Only tell non-players they aren't once per thread
+        if (not player and getattr(comment, 'was_comment', None) and
+                self.authors.tell(name, getattr(comment, 'link_id', None))):
+            self.outbox.enqueue(outbound.CONFIRMATION, 'reply', comment.name,
+                                Command.FAIL_NOT_PLAYER %
+                                self.config.headquarters)
         return player
 
     def generate_markdown_report(self, loop_start):
@@ -96,10 +142,16 @@ class Bot(object):
         s = self.session
 
         land_report = StatusCommand.lands_status_for(s, self.config)
-        hq = self.reddit.get_subreddit(self.config.headquarters)
 
         cur = now()
-        elapsed = (cur - loop_start) + self.config["bot"]["sleep"]
+        # Measured from the start of the last frame to this one's, so it
+        # covers however long we actually slept; the first frame only has
+        # itself to go by
+        if self.last_start is None:
+            elapsed = cur - loop_start
+        else:
+            elapsed = loop_start - self.last_start
+        self.last_start = loop_start
 
         bot_report = ("Bot Status:\n\n"
                       "* Last run at %s\n\n"
@@ -109,7 +161,9 @@ class Bot(object):
 
         # This is apparently not immediately done, or there's some caching.
         # Keep an eye on it.
-        hq.update_settings(description=report)
+        self.outbox.enqueue(outbound.SIDEBAR, 'settings',
+                            self.config.headquarters, report)
+        s.commit()
 
     def generate_reports(self, loop_start):
         logging.info("Generating reports")
@@ -150,32 +204,127 @@ class Bot(object):
                 jdict[r.srname] = rdict
             j.write(json.dumps(jdict))
 
-    def process_post_for_battle(self, post, battle, sess):
-        p = sess.query(Processed).filter_by(battle=battle).all()
-        seen = [entry.id36 for entry in p]
+    def process_stream(self, battles, sess):
+        """
+        Poll one combined comment listing across every subreddit with an
+        active battle, routing each comment to its battle by link_id, and
+        only going back as far as each battle's high-water mark.
 
+        Returns the battles that couldn't be served from the stream (no mark
+        yet, or the listing didn't reach back far enough) and so still need
+        a full pass with process_post_for_battle.
+        """
+        marked = {}
+        leftover = []
+        for battle in battles:
+            if battle.submission_id and battle.high_water_time:
+                marked[battle.submission_id] = battle
+            else:
+                leftover.append(battle)
+        if not marked:
+            return leftover
+
+        # Stop at the oldest mark; nothing anyone needs is past it
+        oldest = min(marked.values(), key=lambda b: b.high_water_time)
+        place_holder = None
+        if oldest.high_water_name:
+            place_holder = name_to_id(oldest.high_water_name)
+        srnames = sorted(set(b.region.srname for b in marked.values()))
+        listing = self.reddit.get_comments("+".join(srnames), limit=None,
+                                           place_holder=place_holder)
+
+        fresh = dict((sid, []) for sid in marked)
+        pending = set(marked)
+        for comment in listing:
+            battle = marked.get(comment.link_id)
+            if battle and comment.link_id in pending:
+                if comment.name == battle.high_water_name:
+                    pending.discard(comment.link_id)
+                elif comment.created_utc >= battle.high_water_time:
+                    fresh[comment.link_id].append(comment)
+            # Quiet threads never show their mark in the listing, so we also
+            # know we're done with a battle once we're older than its mark.
+            # (This also covers marks that have since been deleted.)
+            for sid in list(pending):
+                if comment.created_utc < marked[sid].high_water_time:
+                    pending.discard(sid)
+            if not pending:
+                break
+
+        for sid, battle in marked.items():
+            if sid in pending:
+                logging.info("Stream didn't reach %s for %s, doing a full "
+                             "pass" % (battle.high_water_name, sid))
+                leftover.append(battle)
+                continue
+            # Listings are newest-first; commands need to be run in order
+            comments = fresh[sid]
+            comments.reverse()
+            self.process_comments_for_battle(comments, battle, sess)
+        return leftover
+
+    def process_post_for_battle(self, post, battle, sess):
         replaced = post.replace_more_comments(limit=None, threshold=0)
         if replaced:
             logging.info("Comments that went un-replaced: %s" % replaced)
         flat_comments = praw.helpers.flatten_tree(
             post.comments)
+        if not battle.high_water_time:
+            # An empty thread still needs a mark for the stream to pick it up
+            battle.high_water_time = int(post.created_utc)
+        self.process_comments_for_battle(flat_comments, battle, sess)
 
-        for comment in flat_comments:
-            if comment.name in seen:
-                continue
-            if not comment.author:  # Deleted comments don't have an author
-                continue
-            if comment.author.name == self.config.username:
-                continue
-            cmd = extract_command(comment.body)
-            if cmd:
-                player = self.find_player(comment, sess)
-                if player:
-                    context = Context(player, self.config, sess,
-                                          comment, self.reddit)
-                    self.command(cmd, context)
-            sess.add(Processed(id36=comment.name, battle=battle))
-            sess.commit()
+    def process_comments_for_battle(self, comments, battle, sess):
+        seen = self.seen_for(battle, sess)
+        processed = []
+
+        try:
+            for comment in comments:
+                if comment.name in seen:
+                    continue
+                if not comment.author:  # Deleted comments have no author
+                    continue
+                if comment.author.name == self.config.username:
+                    continue
+                cmd = extract_command(comment.body)
+                if cmd:
+                    player = self.find_player(comment, sess)
+                    if player:
+                        context = Context(player, self.config, sess,
+                                          comment, self.reddit,
+                                          summaries=self.summaries,
+                                          outbox=self.outbox, seen=seen)
+                        self.command(cmd, context)
+                # Later replies to this in the same pass need to know we've
+                # been here, even though its row isn't written yet
+                processed.append(comment.name)
+                seen.add(comment.name)
+        except:
+            seen.difference_update(processed)
+            raise
+
+        # Done after the commands have run, as any of them may have rolled back
+        if comments:
+            battle.mark_seen(max(comments, key=lambda c: c.created_utc))
+
+        # One insert and one commit for the whole thread
+        sess.add_all([Processed(id36=name, battle=battle)
+                      for name in processed])
+        sess.checkpoint()
+
+    def seen_for(self, battle, sess):
+        """
+        The names of comments already processed in battle, loaded from the
+        database the first time we're asked and kept up to date in memory
+        afterwards
+        """
+        seen = self.seen.get(battle.id)
+        if seen is None:
+            rows = (sess.query(Processed.id36_kind, Processed.id36_num).
+                    filter_by(battle_id=battle.id))
+            seen = set(pair_to_name(kind, num) for kind, num in rows)
+            self.seen[battle.id] = seen
+        return seen
 
     @failable
     def recruit_from_post(self, post):
@@ -190,8 +339,7 @@ class Bot(object):
                 continue
 
             # Is this author already one of us?
-            found = session.query(User).filter_by(
-                name=name).first()
+            found = self.authors.find(session, name)
             if not found:
                 team = 0
                 assignment = self.config['game']['assignment']
@@ -213,7 +361,7 @@ class Bot(object):
                                   newbie.team)
                 newbie.region = cap
 
-                session.commit()
+                session.checkpoint()
                 logging.info("Created combatant %s", newbie)
 
                 reply = ("Welcome to Chroma!  You are now a %s "
@@ -223,32 +371,44 @@ class Bot(object):
                      num_to_team(newbie.team, self.config),
                      newbie.loyalists,
                      cap.markdown())
-                comment.reply(reply)
+                self.outbox.enqueue(outbound.CONFIRMATION, 'reply',
+                                    comment.name, reply)
             else:
                 #logging.info("Already registered %s", comment.author.name)
                 pass
 
-    @failable
     def update_game(self):
+        """
+        Handle whatever deadlines the scheduler says have passed.  Not
+        failable: it doesn't talk to reddit itself, and the game clock
+        mustn't stop just because reddit has.
+        """
         session = self.session
-        MarchingOrder.update_all(session)
+        if self.scheduler.needs_resync():
+            self.scheduler.rebuild(session)
+        due = self.scheduler.pop_due()
+        try:
+            self.update_due(due)
+        except:
+            # Try again next frame; anything already done won't be redone
+            self.scheduler.requeue(due, now() + self.config["bot"]["sleep"])
+            raise
 
-        results = Region.update_all(session, self.config)
-        to_add = []
-        for newternal in results['new_eternal']:
-            title = "The Eternal Battle Rages On"
-            post = InvadeCommand.post_invasion(title, newternal, self.reddit)
-            if post:
-                newternal.submission_id = post.name
-                to_add.append(newternal)
-            else:
-                logging.warn("Couldn't submit eternal battle thread")
-                session.rollback()
-        if to_add:
-            session.add_all(to_add)
-            session.commit()
+    def update_due(self, due):
+        session = self.session
+        if due['arrival']:
+            orders = session.query(MarchingOrder).filter(
+                MarchingOrder.id.in_(due['arrival'])).all()
+            MarchingOrder.update_all(session, orders)
 
-        results = Battle.update_all(session)
+        if due['eternal']:
+            self.update_eternal()
+
+        if not (due['begins'] or due['ends']):
+            return
+        battles = session.query(Battle).filter(
+            Battle.id.in_(due['begins'] | due['ends'])).all()
+        results = Battle.update_all(session, battles)
 
         for ready in results['begin']:
             ready.ends = ready.begins + self.config["game"]["battle_time"]
@@ -256,10 +416,8 @@ class Bot(object):
                     "The battle has begun now, and will end at %s.\n\n"
                     "> Enter your commands in this thread, prefixed with "
                     "'>'") % ready.ends_str()
-            post = self.reddit.get_submission(
-                submission_id=name_to_id(ready.submission_id))
-            post.edit(text)
-            session.commit()
+            self.edit_post(ready, text)
+            session.checkpoint()
 
         for done in results['ended']:
             report = ["The battle is complete...\n"]
@@ -278,23 +436,52 @@ class Bot(object):
                 report.append("# TIE")
 
             text = "\n".join(report)
-            post = self.reddit.get_submission(
-                submission_id=name_to_id(done.submission_id))
-            post.edit(text)
-
-            # Update all the skirmish summaries
-            for s in done.toplevel_skirmishes():
-                c = Context(player=None,
-                            config=self.config,
-                            session=None,
-                            comment=None,
-                            reddit=self.reddit)
-                SkirmishCommand.update_summary(c, s)
-
-            session.delete(done)
-            session.commit()
+            self.edit_post(done, text)
+
+            # Update all the skirmish summaries, while they're still here
+            toplevel = done.toplevel_skirmishes()
+            for s in toplevel:
+                self.summaries.mark(s)
+            self.summaries.flush(session, self.reddit, self.config,
+                                 self.outbox)
+            for s in toplevel:
+                self.summaries.forget(s)
+
+            self.seen.pop(done.id, None)
+            done.teardown()
+            session.checkpoint()
+
+        if results['ended']:
+            # Eternal regions will want a new battle
+            self.scheduler.push(now(), 'eternal')
+
+    def edit_post(self, battle, text):
+        """Queue an edit of battle's post; only the last one queued is sent"""
+        self.outbox.enqueue(outbound.BATTLE, 'edit', battle.submission_id,
+                            text)
+
+    def update_eternal(self):
+        session = self.session
+        results = Region.update_all(session, self.config)
+        to_add = []
+        for newternal in results['new_eternal']:
+            title = "The Eternal Battle Rages On"
+            post = InvadeCommand.post_invasion(title, newternal, self.reddit)
+            if post:
+                newternal.submission_id = post.name
+                to_add.append(newternal)
+            else:
+                logging.warn("Couldn't submit eternal battle thread")
+                # Take just this battle back out, not the rest of the frame
+                newternal.region = None
+                session.expunge(newternal)
+                self.scheduler.push(now() + self.config["bot"]["sleep"],
+                                    'eternal')
+        if to_add:
+            session.add_all(to_add)
+            session.checkpoint()
 
-    @failable
+    @retried
     def login(self):
         reddit.login(c.username, c.password)
         return True
@@ -302,23 +489,57 @@ class Bot(object):
     def run(self):
         logging.info("Bot started up")
         logged_in = self.login()
+        self.outbox.recover()
         while(logged_in):
             loop_start = now()
             self.config.refresh()
-            logging.info("Checking headquarters")
-            self.check_hq()
-            logging.info("Checking Messages")
-            self.check_messages()
-            logging.info("Checking Battles")
-            self.check_battles()
-            logging.info("Updating game state")
-            self.update_game()
+            self.frame()
             # generate_reports logs itself
             self.generate_reports(loop_start)
+            # Wake up early if a battle or army is due before then, sending
+            # what we've queued up in the meantime
+            wake = time.time() + self.scheduler.sleep_time(
+                self.config["bot"]["sleep"])
+            logging.info("Sending %d queued actions" % len(self.outbox))
+            self.outbox.drain(until=wake)
+            self.outbox.prune(now() - 60 * 60 * 24)
             logging.info("Sleeping")
-            time.sleep(self.config["bot"]["sleep"])
+            time.sleep(max(0, wake - time.time()))
         logging.fatal("Unable to log into bot; shutting down")
 
+    def frame(self):
+        """
+        Deal with everything that's happened, as one transaction.  If
+        anything goes wrong, the whole frame is rolled back and tried again
+        next time, rather than the bot stopping.  Returns whether it
+        committed.
+        """
+        self.handled = []
+        try:
+            with self.session.unit_of_work():
+                logging.info("Checking headquarters")
+                self.check_hq()
+                logging.info("Checking Messages")
+                self.check_messages()
+                logging.info("Checking Battles")
+                self.check_battles()
+                logging.info("Updating game state")
+                self.update_game()
+                # Queued edits roll back with the rest of the frame, so we
+                # never show anything that didn't happen
+                logging.info("Updating skirmish summaries")
+                self.summaries.flush(self.session, self.reddit, self.config,
+                                     self.outbox)
+        except Exception:
+            # update_game has put back whatever was due, and the PMs we
+            # handled are still unread
+            logging.error("Frame failed, will try again: %s" %
+                          traceback.format_exc())
+            return False
+        self.read.extend(self.handled)
+        self.mark_read()
+        return True
+
 if __name__ == '__main__':
     fmt = "%(asctime)s: %(levelname)s %(message)s"
     logging.basicConfig(level=logging.INFO, format=fmt)
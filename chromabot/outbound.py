@@ -0,0 +1,249 @@
+"""
+Paced, durable delivery of what the bot says to reddit.  Commands and game
+updates queue their replies, PMs and edits in the outbox table instead of
+making the API calls inline, and the bot sends them between frames, most
+urgent first, as fast as a token bucket allows.
+"""
+import hashlib
+import logging
+import time
+import traceback
+
+import praw
+from requests.exceptions import ConnectionError
+
+import breaker
+from db import Outgoing
+
+# Priority classes, most urgent first
+BATTLE = 0          # Battle posts starting and ending
+CONFIRMATION = 1    # Replies to commands, skirmish summaries
+MESSAGE = 2         # Status PMs and the like
+SIDEBAR = 3         # The headquarters sidebar report
+
+# PMs to the same player are sent as one, split by rules, up to what reddit
+# will take in a message
+DIGEST_SEPARATOR = "\n\n*****\n\n"
+MESSAGE_LIMIT = 10000
+
+
+class TokenBucket(object):
+    """Allows rate actions a second on average, in bursts of up to burst"""
+
+    def __init__(self, rate, burst, clock=time.time):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.clock = clock
+        self.stamp = clock()
+
+    def refill(self):
+        current = self.clock()
+        elapsed = max(0, current - self.stamp)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.stamp = current
+
+    def take(self):
+        """Use up a token if there's one to be had"""
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self):
+        """How long until there'll be a token"""
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Outbound(object):
+    """
+    The outbox: actions are saved as db.Outgoing rows by enqueue(), in the
+    caller's transaction, and sent by drain() with each one committed as
+    being in flight before it's tried and as sent afterwards.
+    """
+
+    # Failures that mean reddit definitely didn't act on the request
+    UNSENT = (praw.errors.APIException, ConnectionError)
+
+    def __init__(self, session, reddit, bucket, sleep=time.sleep,
+                 attempts=5, digest=True, breaker=breaker.reddit):
+        self.session = session
+        self.reddit = reddit
+        self.bucket = bucket
+        self.sleep = sleep
+        self.attempts = attempts
+        self.digest = digest
+        self.breaker = breaker
+
+    @classmethod
+    def from_config(cls, session, reddit, config):
+        bot = config["bot"]
+        return cls(session, reddit,
+                   TokenBucket(bot.get("write_rate", 0.5),
+                               bot.get("write_burst", 10)),
+                   digest=bot.get("digest", True))
+
+    def __len__(self):
+        return self.queued().count()
+
+    def queued(self):
+        return (self.session.query(Outgoing).filter_by(state='queued').
+                order_by(Outgoing.priority, Outgoing.id))
+
+    def enqueue(self, priority, kind, target, body, subject=None):
+        """
+        Queue an action: a 'pm' to a user, a 'reply' to a fullname, an
+        'edit' of a fullname or new 'settings' (the description) for a
+        subreddit.  An edit or settings change replaces any still-queued one
+        for the same target, as only the last matters.  Anything else is
+        only queued once, however many times it's asked for.
+        """
+        sess = self.session
+        if kind in Outgoing.IDEMPOTENT:
+            pending = (sess.query(Outgoing).
+                       filter_by(state='queued', kind=kind, target=target).
+                       first())
+            if pending:
+                pending.body = body
+                pending.priority = min(pending.priority, priority)
+                return pending
+            key = None
+        else:
+            key = hashlib.sha1(u"\0".join(
+                [kind, target, subject or u"", body]).encode('utf-8')
+            ).hexdigest()
+            if sess.query(Outgoing).filter_by(key=key).count():
+                return None
+        item = Outgoing(key=key, priority=priority, kind=kind, target=target,
+                        subject=subject, body=body)
+        sess.add(item)
+        return item
+
+    def recover(self):
+        """
+        Deal with anything we were in the middle of sending when we last
+        stopped: resend it if that's safe, otherwise give up on it
+        """
+        for item in self.session.query(Outgoing).filter_by(state='sending'):
+            if item.idempotent:
+                item.state = 'queued'
+            else:
+                logging.warning("May or may not have sent %s, not retrying" %
+                                item)
+                item.state = 'failed'
+        self.session.commit()
+
+    def drain(self, until=None):
+        """
+        Send queued actions in priority order, a player's PMs together as
+        one digest.  Without until, stops as soon as the bucket runs dry;
+        otherwise waits for tokens until then.  Returns how many queued
+        actions were sent.
+        """
+        sess = self.session
+        sent = 0
+        # Anything that fails waits for the next drain before another try
+        failed = set([-1])
+        item = self.queued().first()
+        while item:
+            # Before taking a token, so none are used up while it's down
+            if not self.breaker.allow():
+                logging.info("Reddit is down, holding %d queued actions" %
+                             len(self))
+                break
+            if not self.bucket.take():
+                wait = self.bucket.wait_time()
+                if until is None or self.bucket.clock() + wait > until:
+                    break
+                self.sleep(wait)
+                continue
+            batch = self.digest_for(item)
+            for each in batch:
+                each.state = 'sending'
+                each.attempts += 1
+            sess.commit()
+            try:
+                self.send(item, DIGEST_SEPARATOR.join(
+                    each.body for each in batch))
+                for each in batch:
+                    each.state = 'sent'
+                sent += len(batch)
+                self.breaker.success()
+            except self.UNSENT:
+                logging.warning("Couldn't send %s: %s" %
+                                (item, traceback.format_exc()))
+                self.breaker.failure()
+                for each in batch:
+                    failed.add(each.id)
+                    if each.attempts < self.attempts:
+                        each.state = 'queued'
+                    else:
+                        each.state = 'failed'
+            except Exception as e:
+                logging.warning("Failed sending %s: %s" %
+                                (item, traceback.format_exc()))
+                if isinstance(e, breaker.ERRORS):
+                    self.breaker.failure()
+                # It may or may not have gone through
+                for each in batch:
+                    failed.add(each.id)
+                    if each.idempotent and each.attempts < self.attempts:
+                        each.state = 'queued'
+                    else:
+                        each.state = 'failed'
+            sess.commit()
+            item = self.queued().filter(~Outgoing.id.in_(failed)).first()
+        return sent
+
+    def digest_for(self, item):
+        """
+        The queued rows to send along with item: with digests on, every PM
+        waiting for the same player under the same subject, oldest first,
+        as many as fit in one message.  Otherwise just item itself.
+        """
+        if not self.digest or item.kind != 'pm':
+            return [item]
+        batch = [item]
+        length = len(item.body)
+        pending = (self.session.query(Outgoing).
+                   filter_by(state='queued', kind='pm', target=item.target,
+                             subject=item.subject).
+                   filter(Outgoing.id != item.id).
+                   order_by(Outgoing.id))
+        for each in pending:
+            length += len(DIGEST_SEPARATOR) + len(each.body)
+            if length > MESSAGE_LIMIT:
+                break
+            batch.append(each)
+        return batch
+
+    def send(self, item, body=None):
+        reddit = self.reddit
+        if body is None:
+            body = item.body
+        if item.kind == 'pm':
+            reddit.send_message(item.target, item.subject, body)
+        elif item.kind == 'reply':
+            # What praw's reply() does, minus needing the thing in hand
+            reddit._add_comment(item.target, body)
+        elif item.kind == 'edit':
+            thing = reddit.get_info(thing_id=item.target)
+            if thing:
+                thing.edit(body)
+        elif item.kind == 'settings':
+            reddit.get_subreddit(item.target).update_settings(
+                description=body)
+        else:
+            raise ValueError("Don't know how to send %s" % item)
+
+    def prune(self, older_than):
+        """Forget what was sent (or given up on) before older_than"""
+        (self.session.query(Outgoing).
+         filter(Outgoing.state.in_(['sent', 'failed'])).
+         filter(Outgoing.created < older_than).
+         delete(synchronize_session=False))
+        self.session.commit()
@@ -1,8 +1,8 @@
 from pyparsing import *
 
 from commands import (CodewordCommand, DefectCommand, InvadeCommand,
-                      MoveCommand, PromoteCommand, SkirmishCommand,
-                      StatusCommand, TimeCommand)
+                      MoveCommand, PromoteCommand, SimulateCommand,
+                      SkirmishCommand, StatusCommand, TimeCommand)
 
 number = Word(nums)
 string = QuotedString('"', '\\')
@@ -23,6 +23,12 @@ skirmishcmd = (participate("action") + Optional(target) +
                Optional(eolstring)("troop_type"))
 skirmishcmd.setParseAction(SkirmishCommand)
 
+simulate = Keyword("simulate")
+simulatecmd = (simulate + Optional(participate("action")) + target +
+               Suppress("with") + number("amount") +
+               Optional(eolstring)("troop_type"))
+simulatecmd.setParseAction(SimulateCommand)
+
 invade = Keyword("invade")
 invadecmd = invade + location("where")
 invadecmd.setParseAction(InvadeCommand)
@@ -56,7 +62,7 @@ statuscmd = Keyword("status")
 statuscmd.setParseAction(StatusCommand)
 
 root = (statuscmd | movecmd | invadecmd | skirmishcmd | defectcmd |
-        promotecmd | timecmd | codewordcmd)
+        promotecmd | timecmd | codewordcmd | simulatecmd)
 
 
 def parse(s):
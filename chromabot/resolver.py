@@ -0,0 +1,392 @@
+"""
+Skirmish resolution on plain records rather than ORM objects, so a whole
+battle's worth of skirmish trees can be loaded in one query and resolved in
+one pass without recursion.
+
+If numpy is available, many forests can also be resolved together a whole
+tree level at a time; see Forest.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SUPPORT_ORDER = ["cavalry", "infantry", "ranged"]
+ATTACK_ORDER = ["ranged", "infantry", "cavalry"]
+
+
+def adjusted_for_type(our_type, other_type, amount, support=False):
+    """Certain types will be more effective vs. a skirmish of our_type"""
+    if support:
+        ordering = SUPPORT_ORDER
+    else:
+        ordering = ATTACK_ORDER
+    our_index = ordering.index(our_type)
+    penalty = ordering[our_index - 1]
+    bonus = ordering[(our_index + 1) % len(ordering)]
+    result = amount
+    if other_type == penalty:
+        result = int(amount / 2)
+    elif other_type == bonus:
+        result = int(amount * 1.5)
+    return result
+
+
+class Node(object):
+    """
+    One skirmish action, and once resolved, its results.  Also keeps the
+    totals it collected from its children, so that a change lower down can
+    be passed up without looking at the siblings again.
+    """
+
+    __slots__ = ['id', 'parent_id', 'team', 'amount', 'hinder', 'troop_type',
+                 'children', 'victor', 'vp', 'margin', 'unopposed',
+                 'support', 'raw_support', 'attack', 'raw_attack', 'child_vp']
+
+    RESULTS = ['victor', 'vp', 'margin', 'unopposed']
+
+    def __init__(self, id, parent_id, team, amount, hinder, troop_type):
+        self.id = id
+        self.parent_id = parent_id
+        self.team = team
+        self.amount = amount
+        self.hinder = hinder
+        self.troop_type = troop_type
+        self.children = []
+        self.victor = None
+        self.vp = None
+        self.margin = None
+        self.unopposed = None
+
+    @property
+    def is_root(self):
+        return self.parent_id is None
+
+    def results(self):
+        return dict((attr, getattr(self, attr)) for attr in self.RESULTS)
+
+    def contribution(self, parent):
+        """
+        What this (resolved) node adds to parent's totals, as a tuple of
+        (support, raw_support, attack, raw_attack, vp)
+        """
+        support = raw_support = attack = raw_attack = 0
+        if not self.hinder:
+            # Support only counts if it didn't get ambushed on the way
+            if self.victor == parent.team:
+                raw_support = self.margin
+                support = adjusted_for_type(parent.troop_type,
+                                            self.troop_type, self.margin,
+                                            support=True)
+        elif self.victor != parent.team:
+            # Attackers only count if they weren't beaten by our team
+            raw_attack = self.margin
+            attack = adjusted_for_type(parent.troop_type, self.troop_type,
+                                       self.margin)
+        return (support, raw_support, attack, raw_attack, self.vp)
+
+    def absorb(self, contribution, sign=1):
+        """Add (or with sign=-1, take away) a child's contribution"""
+        support, raw_support, attack, raw_attack, vp = contribution
+        self.support += sign * support
+        self.raw_support += sign * raw_support
+        self.attack += sign * attack
+        self.raw_attack += sign * raw_attack
+        self.child_vp += sign * vp
+
+    def resolve(self):
+        """Resolve this node; its children must already be resolved"""
+        self.support = self.raw_support = self.amount
+        self.attack = self.raw_attack = self.child_vp = 0
+        for child in self.children:
+            self.absorb(child.contribution(self))
+        return self.settle()
+
+    def settle(self):
+        """Work out this node's results from the totals it has collected"""
+        team = self.team
+        self.victor = team
+        self.vp = 0
+        self.margin = self.amount
+        self.unopposed = True
+
+        if self.children:
+            support = self.support
+            attack = self.attack
+            self.vp = self.child_vp
+            self.unopposed = attack == 0
+
+            if attack > support:
+                # This skirmish loses!
+                self.margin = attack - support
+                self.victor = [1, 0][team]
+                self.vp += self.raw_support
+            elif support > attack:
+                # This skirmish wins!
+                self.margin = support - attack
+                self.victor = team
+                self.vp += self.raw_attack
+            else:
+                # Nobody is the winner, but this skirmish is sure the loser
+                self.victor = None
+                self.margin = 0
+                self.vp += max(self.raw_attack, self.raw_support)
+        # Unopposed root nodes are worth 2x VP
+        if self.is_root and self.unopposed:
+            self.vp = max(self.vp * 2, self.amount * 2)
+        return self
+
+
+def link(nodes):
+    """
+    Hook each node up to its children, returning the ones whose parents
+    aren't among nodes (the roots of the forest)
+    """
+    by_id = dict((node.id, node) for node in nodes)
+    tops = []
+    for node in nodes:
+        node.children = []
+    for node in nodes:
+        parent = by_id.get(node.parent_id)
+        if parent is None:
+            tops.append(node)
+        else:
+            parent.children.append(node)
+    return tops
+
+
+def resolve_forest(nodes):
+    """
+    Resolve every node, children before parents, using an explicit stack
+    so that deep trees can't hit the recursion limit.  Returns the tops of
+    the forest as given by link().
+    """
+    tops = link(nodes)
+    stack = [(top, False) for top in tops]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            node.resolve()
+        else:
+            stack.append((node, True))
+            stack.extend((child, False) for child in node.children)
+    return tops
+
+
+class Scoreboard(object):
+    """
+    Running standings for one battle.  Resolves the whole forest once, then
+    as each new action arrives, re-resolves only the path from it up to its
+    root using the totals each node keeps.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = dict((node.id, node) for node in nodes)
+        self.score = [0, 0]
+        for top in resolve_forest(nodes):
+            self.tally(top)
+
+    def tally(self, top, sign=1):
+        """Count (or uncount) a resolved tree towards the score"""
+        if top.is_root and top.victor is not None:
+            self.score[top.victor] += sign * top.vp
+
+    def add(self, node):
+        """Take a new action into account.  Its parent must already be here"""
+        path = [node]
+        parent = self.nodes.get(node.parent_id)
+        while parent is not None:
+            path.append(parent)
+            parent = self.nodes.get(parent.parent_id)
+        top = path[-1]
+        # What each ancestor gives its own parent now, before the change
+        before = [None] + [child.contribution(parent)
+                           for child, parent in zip(path[1:], path[2:])]
+        if top is not node:
+            self.tally(top, -1)
+
+        self.nodes[node.id] = node
+        node.children = []
+        node.resolve()
+        if len(path) > 1:
+            path[1].children.append(node)
+        for old, child, parent in zip(before, path, path[1:]):
+            new = child.contribution(parent)
+            if new == old:
+                # Nothing changes from here up
+                break
+            if old is not None:
+                parent.absorb(old, -1)
+            parent.absorb(new)
+            parent.settle()
+        self.tally(top)
+        return node
+
+
+def resolve_batch(nodes):
+    """
+    Like resolve_forest, but vectorised when numpy is available.  Meant for
+    resolving several battles' worth of skirmishes at once.
+    """
+    if numpy is None or not nodes:
+        return resolve_forest(nodes)
+    forest = Forest(nodes)
+    forest.store(*forest.resolve())
+    return forest.tops
+
+
+class Forest(object):
+    """
+    Skirmish trees flattened into parallel arrays, breadth first, so each
+    level of every tree is one contiguous slice whose children are grouped
+    by parent.  resolve() then works from the deepest level up, doing each
+    level with a handful of array operations, and gives exactly the same
+    answers as Node.resolve.
+    """
+
+    # adjusted_for_type(ours, theirs, amount) == amount * numer // 2, where
+    # numer is looked up in these tables by troop code (ATTACK_ORDER index)
+    SUPPORT_NUMER = [[adjusted_for_type(ours, theirs, 2, support=True)
+                      for theirs in ATTACK_ORDER] for ours in ATTACK_ORDER]
+    ATTACK_NUMER = [[adjusted_for_type(ours, theirs, 2)
+                     for theirs in ATTACK_ORDER] for ours in ATTACK_ORDER]
+
+    def __init__(self, nodes):
+        self.tops = link(nodes)
+        order = list(self.tops)
+        parent = [-1] * len(order)
+        bounds = [0]
+        while bounds[-1] < len(order):
+            end = len(order)
+            for i in xrange(bounds[-1], end):
+                for child in order[i].children:
+                    order.append(child)
+                    parent.append(i)
+            bounds.append(end)
+        self.nodes = order
+        self.index = dict((node.id, i) for i, node in enumerate(order))
+
+        codes = dict((troop, i) for i, troop in enumerate(ATTACK_ORDER))
+        self.parent = numpy.array(parent, dtype=numpy.int64)
+        self.team = numpy.array([n.team for n in order], dtype=numpy.int64)
+        self.amount = numpy.array([n.amount for n in order],
+                                  dtype=numpy.int64)
+        self.hinder = numpy.array([bool(n.hinder) for n in order],
+                                  dtype=bool)
+        self.troop = numpy.array([codes[n.troop_type] for n in order],
+                                 dtype=numpy.int64)
+        self.root = numpy.array([n.is_root for n in order], dtype=bool)
+        self.leaf = numpy.ones(len(order), dtype=bool)
+        self.leaf[self.parent[self.parent >= 0]] = False
+
+        support_numer = numpy.array(self.SUPPORT_NUMER, dtype=numpy.int64)
+        attack_numer = numpy.array(self.ATTACK_NUMER, dtype=numpy.int64)
+        # Everything about how a level feeds its parents that doesn't
+        # depend on the results
+        self.levels = []
+        for lo, hi in zip(bounds, bounds[1:]):
+            level = {'lo': lo, 'hi': hi}
+            parents = self.parent[lo:hi]
+            if lo > 0:
+                uniq, starts = numpy.unique(parents, return_index=True)
+                ptroop = self.troop[parents]
+                ctroop = self.troop[lo:hi]
+                level.update({
+                    'parents': uniq,
+                    'starts': starts,
+                    'pteam': self.team[parents],
+                    'support_numer': support_numer[ptroop, ctroop],
+                    'attack_numer': attack_numer[ptroop, ctroop],
+                })
+            self.levels.append(level)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def resolve(self, amount=None):
+        """
+        Resolve every tree, returning arrays of victor (-1 for a draw), vp,
+        margin and unopposed in the order of self.nodes.
+
+        amount defaults to each node's own amount.  It may have extra
+        leading dimensions to resolve many variations of the same trees at
+        once; the results then have the same shape.
+        """
+        if amount is None:
+            amount = self.amount
+        amount = numpy.asarray(amount, dtype=numpy.int64)
+
+        victor = numpy.empty(amount.shape, dtype=numpy.int64)
+        vp = numpy.zeros(amount.shape, dtype=numpy.int64)
+        margin = numpy.zeros(amount.shape, dtype=numpy.int64)
+        unopposed = numpy.ones(amount.shape, dtype=bool)
+        # Running totals each node collects from its children
+        support = amount.copy()
+        raw_support = amount.copy()
+        attack = numpy.zeros(amount.shape, dtype=numpy.int64)
+        raw_attack = numpy.zeros(amount.shape, dtype=numpy.int64)
+        child_vp = numpy.zeros(amount.shape, dtype=numpy.int64)
+
+        where = numpy.where
+        for level in reversed(self.levels):
+            lo, hi = level['lo'], level['hi']
+            team = self.team[lo:hi]
+            leaf = self.leaf[lo:hi]
+            amt = amount[..., lo:hi]
+            sup = support[..., lo:hi]
+            att = attack[..., lo:hi]
+            wins = sup > att
+            loses = att > sup
+
+            v = where(loses, 1 - team, where(wins, team, -1))
+            m = where(loses, att - sup, where(wins, sup - att, 0))
+            p = child_vp[..., lo:hi] + where(
+                loses, raw_support[..., lo:hi],
+                where(wins, raw_attack[..., lo:hi],
+                      numpy.maximum(raw_attack[..., lo:hi],
+                                    raw_support[..., lo:hi])))
+            u = att == 0
+
+            v = where(leaf, team, v)
+            m = where(leaf, amt, m)
+            p = where(leaf, 0, p)
+            u = u | leaf
+            # Unopposed root nodes are worth 2x VP
+            p = where(self.root[lo:hi] & u, numpy.maximum(p * 2, amt * 2), p)
+
+            victor[..., lo:hi] = v
+            margin[..., lo:hi] = m
+            vp[..., lo:hi] = p
+            unopposed[..., lo:hi] = u
+
+            if lo == 0:
+                continue
+            # Hand this level's results up to the parents
+            hinder = self.hinder[lo:hi]
+            helps = ~hinder & (v == level['pteam'])
+            hurts = hinder & (v != level['pteam'])
+            parents, starts = level['parents'], level['starts']
+
+            def total(values):
+                return numpy.add.reduceat(values, starts, axis=-1)
+
+            raw_support[..., parents] += total(where(helps, m, 0))
+            support[..., parents] += total(
+                where(helps, m * level['support_numer'] // 2, 0))
+            raw_attack[..., parents] += total(where(hurts, m, 0))
+            attack[..., parents] += total(
+                where(hurts, m * level['attack_numer'] // 2, 0))
+            child_vp[..., parents] += total(p)
+
+        return victor, vp, margin, unopposed
+
+    def store(self, victor, vp, margin, unopposed):
+        """Copy results from resolve() back onto the nodes"""
+        rows = zip(self.nodes, victor.tolist(), vp.tolist(), margin.tolist(),
+                   unopposed.tolist())
+        for node, v, p, m, u in rows:
+            node.victor = None if v < 0 else v
+            node.vp = p
+            node.margin = m
+            node.unopposed = u
@@ -0,0 +1,122 @@
+import heapq
+import logging
+from collections import defaultdict
+
+from sqlalchemy import event, or_
+from sqlalchemy.orm.attributes import get_history
+
+from db import Battle, MarchingOrder
+from utils import now
+
+
+class Scheduler(object):
+    """
+    Keeps a heap of upcoming game deadlines (battles beginning and ending,
+    armies arriving) so the bot knows when it next has something to do,
+    and which rows it needs to look at when it does.
+
+    Entries are only hints: whoever handles a due entry still checks the
+    row itself, so stale entries (rescheduled or deleted rows) are harmless.
+    """
+
+    def __init__(self, resync=600):
+        self.heap = []
+        self.resync = resync
+        self.synced_at = None
+
+    def push(self, when, kind, ident=None):
+        heapq.heappush(self.heap, (when, kind, ident))
+
+    def push_battle(self, battle):
+        if battle.id is None:
+            return
+        if battle.begins:
+            self.push(battle.begins, 'begins', battle.id)
+        if battle.ends:
+            self.push(battle.ends, 'ends', battle.id)
+
+    def push_order(self, order):
+        if order.id is not None:
+            self.push(order.arrival, 'arrival', order.id)
+
+    def rebuild(self, sess):
+        """
+        Throw away what we know and reload every deadline.  Of the ones
+        that have already passed, only battles the database says still
+        need handling (Battle.due) are kept, so battles long since begun
+        don't come back around each resync.  Orders are deleted once
+        they've arrived, so every one left is wanted.
+        """
+        current = now()
+        self.heap = []
+        for bid, begins, ends in (
+                sess.query(Battle.id, Battle.begins, Battle.ends).
+                filter(or_(Battle.begins > current, Battle.ends > current))):
+            if begins > current:
+                self.heap.append((begins, 'begins', bid))
+            if ends > current:
+                self.heap.append((ends, 'ends', bid))
+        for bid, ends in (sess.query(Battle.id, Battle.ends).
+                          filter(Battle.due(current))):
+            kind = 'ends' if ends and ends <= current else 'begins'
+            self.heap.append((current, kind, bid))
+        for oid, arrival in sess.query(MarchingOrder.id,
+                                       MarchingOrder.arrival):
+            self.heap.append((arrival, 'arrival', oid))
+        # Eternal battles may need (re)starting whenever we've lost track
+        self.heap.append((current, 'eternal', None))
+        heapq.heapify(self.heap)
+        self.synced_at = current
+        logging.info("Scheduler synced, %d deadlines" % len(self.heap))
+
+    def watch(self, sess):
+        """Pick up deadlines from battles and orders as they're flushed"""
+        event.listen(sess, "after_flush", self.after_flush)
+
+    def after_flush(self, sess, flush_context):
+        for obj in sess.new:
+            if isinstance(obj, Battle):
+                self.push_battle(obj)
+            elif isinstance(obj, MarchingOrder):
+                self.push_order(obj)
+        # Battles get dirtied all the time by new skirmishes; only care if
+        # one of their deadlines moved
+        for obj in sess.dirty:
+            if isinstance(obj, Battle):
+                for kind in ('begins', 'ends'):
+                    if get_history(obj, kind).has_changes():
+                        self.push(getattr(obj, kind), kind, obj.id)
+            elif isinstance(obj, MarchingOrder):
+                if get_history(obj, 'arrival').has_changes():
+                    self.push_order(obj)
+
+    def pop_due(self, when=None):
+        """
+        Remove and return every entry due by when, as a dict of
+        kind -> set of ids
+        """
+        if when is None:
+            when = now()
+        result = defaultdict(set)
+        while self.heap and self.heap[0][0] <= when:
+            _, kind, ident = heapq.heappop(self.heap)
+            result[kind].add(ident)
+        return result
+
+    def requeue(self, due, when=None):
+        """Put entries from pop_due back, e.g. if handling them failed"""
+        if when is None:
+            when = now()
+        for kind, idents in due.items():
+            for ident in idents:
+                self.push(when, kind, ident)
+
+    def needs_resync(self):
+        return (self.synced_at is None or
+                now() - self.synced_at >= self.resync)
+
+    def sleep_time(self, longest):
+        """How long to sleep: until the next deadline, but at most longest"""
+        if not self.heap:
+            return longest
+        return max(0, min(longest, self.heap[0][0] - now()))
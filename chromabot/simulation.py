@@ -0,0 +1,101 @@
+"""
+What-if resolution of a single skirmish tree, for the simulate command.
+Works on a copy of the tree as plain resolver nodes, so nothing here goes
+near the database session, and uses the vectorised resolver so that
+thousands of variations cost about as much as a handful.
+"""
+from collections import defaultdict
+
+import resolver
+from resolver import ATTACK_ORDER, Forest, Node
+
+
+def available():
+    """Simulations need numpy"""
+    return resolver.numpy is not None
+
+
+class Simulation(object):
+
+    # Most array cells to resolve at once, to keep memory use bounded
+    CELLS = 500000
+
+    def __init__(self, nodes, root_id):
+        """Copy the tree under root_id out of nodes (e.g. a scoreboard's)"""
+        by_parent = defaultdict(list)
+        for node in nodes:
+            by_parent[node.parent_id].append(node)
+        by_id = dict((node.id, node) for node in nodes)
+
+        self.root_id = root_id
+        self.nodes = []
+        pending = [by_id[root_id]]
+        while pending:
+            node = pending.pop()
+            self.nodes.append(Node(node.id, node.parent_id, node.team,
+                                   node.amount, node.hinder, node.troop_type))
+            pending.extend(by_parent[node.id])
+        self.teams = dict((node.id, node.team) for node in self.nodes)
+
+    def __contains__(self, node_id):
+        return node_id in self.teams
+
+    def what_if(self, parent_id, hinder, amount, troop_type):
+        """
+        How the tree resolves as it stands, and with one more action of
+        amount troop_type under parent_id.  Returns two (victor, margin, vp)
+        tuples, victor being None for a tie.
+        """
+        numpy = resolver.numpy
+        team = self.teams[parent_id]
+        if hinder:
+            team = 1 - team
+        extra = Node(-1, parent_id, team, amount, hinder, troop_type)
+        forest = Forest(self.nodes + [extra])
+        # An action with no troops in it changes nothing, so "as it stands"
+        # is just the same forest with the extra action emptied out
+        amounts = numpy.tile(forest.amount, (2, 1))
+        amounts[0, forest.index[extra.id]] = 0
+        victor, vp, margin, _ = forest.resolve(amounts)
+
+        top = forest.index[self.root_id]
+        return [(None if victor[row, top] < 0 else int(victor[row, top]),
+                 int(margin[row, top]), int(vp[row, top]))
+                for row in (0, 1)]
+
+    def sample(self, team, most, trials, seed=None):
+        """
+        Resolve the tree under trials random responses from team's enemy.
+        Each response is a single action of 1 to most troops of a random
+        type, opposing one of team's actions or supporting one of the
+        enemy's.  Returns how many times team (won, tied, lost).
+        """
+        numpy = resolver.numpy
+        rng = numpy.random.RandomState(seed)
+        enemy = 1 - team
+
+        # Every response we might pick is in the forest, but empty unless
+        # it's the one picked for that trial
+        candidates = []
+        for node in self.nodes:
+            for troop_type in ATTACK_ORDER:
+                candidates.append(Node(-1 - len(candidates), node.id, enemy,
+                                       0, node.team == team, troop_type))
+        forest = Forest(self.nodes + candidates)
+        columns = numpy.array([forest.index[c.id] for c in candidates])
+        top = forest.index[self.root_id]
+
+        won = tied = lost = 0
+        step = max(1, self.CELLS // len(forest))
+        for start in xrange(0, trials, step):
+            count = min(step, trials - start)
+            amounts = numpy.tile(forest.amount, (count, 1))
+            picks = columns[rng.randint(len(candidates), size=count)]
+            amounts[numpy.arange(count), picks] = rng.randint(1, most + 1,
+                                                              size=count)
+            victor = forest.resolve(amounts)[0][:, top]
+            won += int((victor == team).sum())
+            tied += int((victor < 0).sum())
+            lost += int((victor == enemy).sum())
+        return won, tied, lost
+
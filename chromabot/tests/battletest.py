@@ -4,8 +4,12 @@ import logging
 import time
 import unittest
 
+from sqlalchemy import event, inspect
+
 import db
-from db import (Battle, Processed, SkirmishAction)
+from commands import SummaryQueue
+from db import (Battle, Outgoing, Processed, SkirmishAction)
+from outbound import Outbound
 from playtest import ChromaTest
 from utils import now
 
@@ -121,6 +125,26 @@ class TestBattle(ChromaTest):
         self.assertEqual(a1.parent_id, root.id)
         self.assertEqual(a2.parent_id, root.id)
 
+    def test_root_and_depth(self):
+        """Reactions know their root and depth without walking up"""
+        s1 = self.battle.create_skirmish(self.alice, 5)
+        s2 = s1.react(self.bob, 4)
+        s3 = s2.react(self.carol, 3)
+        s4 = s3.react(self.dave, 2)
+        self.sess.commit()
+
+        self.assertEqual([s.root_id for s in (s1, s2, s3, s4)], [s1.id] * 4)
+        self.assertEqual([s.depth for s in (s1, s2, s3, s4)], [0, 1, 2, 3])
+
+        # Once the root's loaded, finding it again takes no queries
+        s1.battle
+        queries = []
+        event.listen(self.db.engine, "before_cursor_execute",
+                        lambda *args: queries.append(args[2]))
+        self.assertEqual(s4.get_root(), s1)
+        self.assertEqual(s4.get_battle(), self.battle)
+        self.assertEqual(queries, [])
+
     def test_battle_skirmish_assoc(self):
         """Make sure top-level skirmishes are associated with their battles"""
         battle = self.battle
@@ -160,6 +184,87 @@ class TestBattle(ChromaTest):
         self.assertEqual(self.sess.query(Processed).count(), 0)
         self.assertEqual(self.sess.query(SkirmishAction).count(), 0)
 
+    def test_teardown(self):
+        """Bulk teardown gets rid of everything the cascade would"""
+        battle = self.battle
+
+        battle.create_skirmish(self.alice, 1)
+        s2 = battle.create_skirmish(self.bob, 1)
+        s2.react(self.alice, 1)
+        battle.processed_comments.append(Processed(id36="foo"))
+        self.sess.commit()
+        # Something from the battle is loaded when it goes
+        self.assertEqual(len(s2.children), 1)
+
+        battle.teardown()
+        self.sess.commit()
+
+        self.assertEqual(self.sess.query(Battle).count(), 0)
+        self.assertEqual(self.sess.query(Processed).count(), 0)
+        self.assertEqual(self.sess.query(SkirmishAction).count(), 0)
+        self.assertIsNone(self.sapphire.battle)
+
+    def test_archive(self):
+        """Finished battles are kept in the archive tables"""
+        battle = self.battle
+        s1 = battle.create_skirmish(self.alice, 10)
+        s1.react(self.bob, 8, troop_type='cavalry')
+        battle.ends = battle.begins
+        self.sess.commit()
+        Battle.update_all(self.sess)
+
+        battle.teardown()
+        self.sess.commit()
+
+        archived = self.sess.query(db.ArchivedBattle).one()
+        self.assertEqual(archived.region, self.sapphire)
+        self.assertEqual(archived.victor, 1)
+        self.assertEqual(archived.score1, 10)
+        self.assertEqual(len(archived.skirmishes), 2)
+
+        root = [s for s in archived.skirmishes if s.parent_id is None][0]
+        child = [s for s in archived.skirmishes if s.parent_id][0]
+        self.assertEqual(child.parent_id, root.skirmish_id)
+        self.assertEqual(child.troop_type, 'cavalry')
+        self.assertEqual(child.participant, self.bob)
+        self.assertEqual(root.victor, 1)
+        self.assertEqual(root.vp, 10)
+
+    def test_high_water_mark(self):
+        """The high-water mark only ever moves forward"""
+        class FakeComment(object):
+            def __init__(self, name, created_utc):
+                self.name = name
+                self.created_utc = created_utc
+
+        self.assertIsNone(self.battle.high_water_name)
+        self.battle.mark_seen(FakeComment("t1_b", 200.0))
+        self.battle.mark_seen(FakeComment("t1_a", 100.0))
+        self.sess.commit()
+
+        self.assertEqual(self.battle.high_water_name, "t1_b")
+        self.assertEqual(self.battle.high_water_time, 200)
+
+    def test_fullname_lookup(self):
+        """Reddit names are stored compactly but still look like names"""
+        s1 = self.battle.create_skirmish(self.alice, 1)
+        s1.comment_id = "t1_c8zk2"
+        self.battle.submission_id = "t3_1k9f"
+        self.sess.commit()
+
+        self.assertIsInstance(s1.comment_num, (int, long))
+        found = self.sess.query(SkirmishAction).filter_by(
+            comment_id="t1_c8zk2").first()
+        self.assertEqual(found, s1)
+        self.assertEqual(found.comment_id, "t1_c8zk2")
+        found = self.sess.query(Battle).filter_by(
+            submission_id="t3_1k9f").first()
+        self.assertEqual(found, self.battle)
+        # Same id, different kind
+        found = self.sess.query(Battle).filter_by(
+            submission_id="t1_1k9f").first()
+        self.assertIsNone(found)
+
     def test_get_battle(self):
         """get_battle and get_root work, right?"""
         battle = self.battle
@@ -244,6 +349,22 @@ class TestBattle(ChromaTest):
 
         self.assertEqual(self.alice.committed_loyalists, old)
 
+    def test_due_battles(self):
+        """Only battles that need updating come back from the due query"""
+        due = self.sess.query(Battle).filter(Battle.due(now()))
+        self.assertEqual(due.count(), 0)
+
+        londo = self.get_region("Orange Londo")
+        londo.owner = None
+        later = londo.invade(self.alice, now() + 60 * 60)
+        self.sess.commit()
+        self.assertEqual(due.count(), 0)
+
+        later.begins = now()
+        self.battle.ends = self.battle.begins
+        self.sess.commit()
+        self.assertEqual(set(due.all()), set([self.battle, later]))
+
     def test_ejection_after_battle(self):
         """We don't want the losers sticking around after the fight"""
         self.battle.submission_id = "TEST"  # So update_all will work correctly
@@ -297,6 +418,18 @@ class TestBattle(ChromaTest):
         with self.assertRaises(db.TimingException):
             self.battle.create_skirmish(self.alice, 1)
 
+    def test_rejection_keeps_session_warm(self):
+        """A rejected skirmish shouldn't expire everything else we've loaded"""
+        s1 = self.battle.create_skirmish(self.alice, 1)
+        self.assertEqual(self.carol.loyalists, 100)
+
+        with self.assertRaises(db.TeamException):
+            s1.react(self.alice, 1, hinder=True)
+
+        self.assertNotIn('loyalists', inspect(self.carol).unloaded)
+        n = self.sess.query(db.SkirmishAction).count()
+        self.assertEqual(n, 1)
+
     def test_commit_at_least_one(self):
         """It isn't a skirmish without fighters"""
         with self.assertRaises(db.InsufficientException):
@@ -719,6 +852,135 @@ class TestBattle(ChromaTest):
         self.assertEqual(updates["ended"][0], self.battle)
         self.assertEqual(0, self.sapphire.owner)
 
+    def test_simultaneous_endings(self):
+        """Battles ending together are resolved as one batch"""
+        sess = self.sess
+        londo = self.get_region("Orange Londo")
+        londo.owner = None
+        other = londo.invade(self.alice, self.battle.begins)
+        other.submission_id = "TEST2"
+        sess.commit()
+
+        s1 = self.battle.create_skirmish(self.alice, 10)
+        s1.react(self.bob, 4)
+        self.battle.create_skirmish(self.bob, 3)
+        self.battle.ends = self.battle.begins
+        other.ends = other.begins
+        sess.commit()
+
+        updates = Battle.update_all(sess)
+        sess.commit()
+
+        self.assertEqual(set(updates["ended"]), set([self.battle, other]))
+        self.assertEqual(s1.victor, 0)
+        self.assertEqual(s1.margin, 6)
+        self.assertEqual((self.battle.score0, self.battle.score1), (4, 6))
+        self.assertEqual((other.score0, other.score1), (0, 0))
+        self.assertEqual(other.victor, None)
+
+    def test_live_standings(self):
+        """The scoreboard keeps up as skirmishes come in"""
+        battle = self.battle
+        self.assertEqual(battle.scoreboard().score, [0, 0])
+
+        s1 = battle.create_skirmish(self.alice, 10)
+        self.assertEqual(battle.scoreboard().score, [20, 0])
+        s1.react(self.bob, 4)
+        self.assertEqual(battle.scoreboard().score, [4, 0])
+
+        # A rejected action (alice can't have two toplevels) doesn't count
+        with self.assertRaises(db.InProgressException):
+            battle.create_skirmish(self.alice, 1)
+        battle.create_skirmish(self.dave, 3)
+        self.assertEqual(battle.scoreboard().score, [4, 6])
+        self.assertEqual(battle.standings(), "Orangered 4, Periwinkle 6")
+
+        battle.ends = battle.begins
+        self.sess.commit()
+        Battle.update_all(self.sess)
+        self.assertEqual((battle.score0, battle.score1), (4, 6))
+
+    def test_standings_rollback(self):
+        """Only rollbacks of actions the scoreboard counted start it over"""
+        battle = self.battle
+        with self.sess.unit_of_work():
+            board = battle.scoreboard()
+            battle.create_skirmish(self.alice, 10)
+            with self.assertRaises(db.InProgressException):
+                battle.create_skirmish(self.alice, 1)
+            self.assert_(battle.scoreboard() is board)
+
+            with self.assertRaises(ValueError):
+                with self.sess.savepoint():
+                    battle.create_skirmish(self.dave, 3)
+                    self.assertEqual(battle.scoreboard().score, [20, 6])
+                    raise ValueError()
+            self.assertFalse(battle.scoreboard() is board)
+            self.assertEqual(battle.scoreboard().score, [20, 0])
+
+    def test_summary_queue(self):
+        """Many reactions to a skirmish, one edit of its summary"""
+        edits = []
+
+        class Summary(object):
+            def edit(self, text):
+                edits.append(text)
+
+        class Reddit(object):
+            def get_info(self, thing_id):
+                return Summary()
+
+        queue = SummaryQueue()
+        s1 = self.battle.create_skirmish(self.alice, 10)
+        s1.summary_id = "t1_summary"
+        queue.posted(s1.summary_id, "\n\n".join(s1.full_details()))
+
+        queue.mark(s1)
+        queue.flush(self.sess, Reddit(), None)
+        self.assertEqual(edits, [])
+
+        s2 = s1.react(self.bob, 4)
+        queue.mark(s2)
+        queue.mark(s1.react(self.dave, 3))
+        queue.mark(s2.react(self.carol, 2))
+        queue.flush(self.sess, Reddit(), None)
+        self.assertEqual(len(edits), 1)
+        self.assertIn("carol", edits[0])
+
+    def test_summary_outbox(self):
+        """Summaries only count as written once the outbox has sent them"""
+        outbox = Outbound(self.sess, None, None)
+        queue = SummaryQueue()
+        s1 = self.battle.create_skirmish(self.alice, 10)
+        s1.summary_id = "t1_summary"
+        self.sess.commit()
+        edits = self.sess.query(Outgoing).filter_by(kind='edit')
+
+        # Rolled back, so queued again next time
+        with self.assertRaises(ValueError):
+            with self.sess.unit_of_work():
+                queue.mark(s1)
+                queue.flush(self.sess, None, None, outbox)
+                self.assertEqual(edits.count(), 1)
+                raise ValueError()
+        queue.flush(self.sess, None, None, outbox)
+        self.assertEqual(edits.count(), 1)
+
+        # Given up on, so queued again too
+        edits.one().state = 'failed'
+        self.sess.commit()
+        queue.flush(self.sess, None, None, outbox)
+        self.assertEqual(edits.filter_by(state='queued').count(), 1)
+
+        # Sent, so there's nothing more to do
+        for edit in edits:
+            edit.state = 'sent'
+        self.sess.commit()
+        queue.mark(s1)
+        queue.flush(self.sess, None, None, outbox)
+        self.assertEqual(edits.count(), 2)
+        self.assert_("t1_summary" in queue.written)
+
     def test_full_battle(self):
         """Full battle"""
         battle = self.battle
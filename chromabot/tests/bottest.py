@@ -0,0 +1,464 @@
+import logging
+import unittest
+
+from requests.exceptions import ConnectionError
+
+import breaker
+from commands import Context
+from db import Battle, Outgoing, Processed, Region, User
+from main import Bot
+from playtest import TEST_LANDS
+from utils import now
+
+
+class MockConf(object):
+    """Enough of a Config to run a Bot against"""
+
+    def __init__(self, **bot):
+        self.dbstring = "sqlite://"
+        self.username = "chromabot"
+        self.headquarters = "chromabot_hq"
+        self.data = {
+            "bot": dict({"sleep": 60}, **bot),
+            "game": {
+                "speed": 0,
+                "battle_delay": 0,
+                "battle_time": 60 * 60 * 24,
+                "sides": ["Orangered", "Periwinkle"],
+                "capital_invasion": "none",
+                "simulations": 100,
+            },
+        }
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def refresh(self):
+        pass
+
+
+class Author(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class Comment(object):
+    """A reddit comment or PM"""
+
+    def __init__(self, name, author, body, link_id=None, parent_id=None,
+                 created_utc=None, was_comment=True):
+        self.name = name
+        self.id = name.split("_", 1)[1]
+        self.author = Author(author) if author else None
+        self.body = body
+        self.link_id = link_id
+        self.parent_id = parent_id or link_id
+        self.created_utc = created_utc or now()
+        self.was_comment = was_comment
+        self.read = False
+        self.fail = False
+        self.replies = []
+
+    @property
+    def permalink(self):
+        if self.fail:
+            raise ConnectionError()
+        return "http://reddit.example/%s" % self.id
+
+    def mark_as_read(self):
+        if self.fail:
+            raise ConnectionError()
+        self.read = True
+
+    def reply(self, text):
+        self.replies.append(text)
+
+
+class StreamComment(Comment):
+    """Like praw's, finding its permalink costs fetching the thread"""
+
+    def __init__(self, reddit, *args, **kwargs):
+        Comment.__init__(self, *args, **kwargs)
+        self.reddit = reddit
+
+    @property
+    def permalink(self):
+        return self.reddit.get_submission(url=self._fast_permalink).url
+
+    @property
+    def _fast_permalink(self):
+        return "http://reddit.example/comments/%s/_/%s" % (
+            self.link_id.split("_")[1], self.id)
+
+
+class Subreddit(object):
+    def get_new(self):
+        return []
+
+
+class Reddit(object):
+    """Serves up canned comments and records what was asked of it"""
+
+    def __init__(self):
+        self.listing = []   # Newest first, as reddit gives them
+        self.things = {}
+        self.unread = []
+        self.calls = []
+
+    def get_comments(self, srnames, limit=None, place_holder=None):
+        self.calls.append(('get_comments', srnames, place_holder))
+        for comment in self.listing:
+            yield comment
+            if comment.id == place_holder:
+                return
+
+    def get_info(self, thing_id=None):
+        self.calls.append(('get_info', thing_id))
+        return self.things.get(thing_id)
+
+    def get_unread(self, *args):
+        self.calls.append(('get_unread',))
+        return [pm for pm in self.unread if not pm.read]
+
+    def get_subreddit(self, name):
+        return Subreddit()
+
+    def get_submission(self, url=None):
+        self.calls.append(('get_submission', url))
+        raise AssertionError("Fetched a whole thread")
+
+
+class BotTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.DEBUG)
+        breaker.reddit.reset()
+        self.reddit = Reddit()
+        self.bot = Bot(MockConf(), self.reddit)
+        self.sess = self.bot.session
+        self.sess.add_all(Region.create_from_json(TEST_LANDS))
+        self.sess.commit()
+        self.alice = self.create_user("alice", 0)
+        self.bob = self.create_user("bob", 1)
+
+    def create_user(self, name, team):
+        user = User(name=name, team=team, loyalists=100, leader=True)
+        user.region = Region.capital_for(team, self.sess)
+        self.sess.add(user)
+        self.sess.commit()
+        return user
+
+    def get_region(self, name):
+        return self.sess.query(Region).filter_by(name=name).first()
+
+    def create_battle(self, where, submission_id, mark_time=None,
+                      mark_name=None):
+        battle = Battle(region=self.get_region(where), begins=0,
+                        ends=now() + 60 * 60 * 24,
+                        submission_id=submission_id,
+                        high_water_time=mark_time,
+                        high_water_name=mark_name)
+        self.sess.add(battle)
+        self.sess.commit()
+        return battle
+
+
+class TestStream(BotTest):
+
+    def setUp(self):
+        BotTest.setUp(self)
+        # Which comments each battle was handed, in order
+        self.handed = {}
+
+        def record(comments, battle, sess):
+            self.handed[battle.id] = [c.name for c in comments]
+        self.bot.process_comments_for_battle = record
+
+    def comment(self, name, link_id, created_utc):
+        return Comment(name, "alice", "Hello", link_id=link_id,
+                       created_utc=created_utc)
+
+    def test_ordering(self):
+        """Comments go to their own battles, oldest first"""
+        londo = self.create_battle("orange londo", "t3_a", 100, "t1_1")
+        sapphire = self.create_battle("sapphire", "t3_b", 110, "t1_2")
+        self.reddit.listing = [
+            self.comment("t1_6", "t3_b", 150),
+            self.comment("t1_5", "t3_a", 140),
+            self.comment("t1_4", "t3_a", 130),
+            self.comment("t1_3", "t3_b", 120),
+            self.comment("t1_2", "t3_b", 110),
+            self.comment("t1_1", "t3_a", 100),
+        ]
+
+        leftover = self.bot.process_stream([londo, sapphire], self.sess)
+        self.assertEqual(leftover, [])
+        self.assertEqual(self.handed, {londo.id: ["t1_4", "t1_5"],
+                                       sapphire.id: ["t1_3", "t1_6"]})
+        # Only went back as far as the oldest mark
+        self.assertEqual(self.reddit.calls,
+                         [('get_comments', "ct_orangelondo+ct_sapphire",
+                           "1")])
+
+    def test_mark_not_reached(self):
+        """A battle whose mark the listing doesn't reach gets a full pass"""
+        londo = self.create_battle("orange londo", "t3_a", 100, "t1_1")
+        sapphire = self.create_battle("sapphire", "t3_b", 160, "t1_3")
+        # Reddit stops giving us comments before londo's mark
+        self.reddit.listing = [
+            self.comment("t1_5", "t3_a", 200),
+            self.comment("t1_4", "t3_b", 180),
+            self.comment("t1_3", "t3_b", 160),
+            self.comment("t1_2", "t3_a", 150),
+        ]
+
+        leftover = self.bot.process_stream([londo, sapphire], self.sess)
+        self.assertEqual(leftover, [londo])
+        self.assertEqual(self.handed, {sapphire.id: ["t1_4"]})
+
+    def test_mark_without_name(self):
+        """A mark that's only a time, from a thread that was empty"""
+        londo = self.create_battle("orange londo", "t3_a", 100)
+        self.reddit.listing = [
+            self.comment("t1_3", "t3_a", 150),
+            self.comment("t1_2", "t3_a", 100),
+            self.comment("t1_1", "t3_a", 50),
+        ]
+
+        leftover = self.bot.process_stream([londo], self.sess)
+        self.assertEqual(leftover, [])
+        self.assertEqual(self.handed, {londo.id: ["t1_2", "t1_3"]})
+        self.assertEqual(self.reddit.calls[0][2], None)
+
+    def test_deleted_mark(self):
+        """A mark that's since been deleted is passed by time instead"""
+        londo = self.create_battle("orange londo", "t3_a", 100, "t1_gone")
+        self.reddit.listing = [
+            self.comment("t1_3", "t3_a", 150),
+            self.comment("t1_2", "t3_a", 90),
+            self.comment("t1_1", "t3_a", 80),
+        ]
+
+        leftover = self.bot.process_stream([londo], self.sess)
+        self.assertEqual(leftover, [])
+        self.assertEqual(self.handed, {londo.id: ["t1_3"]})
+
+    def test_unmarked(self):
+        """Battles without a mark aren't streamed at all"""
+        londo = self.create_battle("orange londo", "t3_a")
+        self.assertEqual(self.bot.process_stream([londo], self.sess),
+                         [londo])
+        self.assertEqual(self.reddit.calls, [])
+
+
+class TestComments(BotTest):
+
+    def setUp(self):
+        BotTest.setUp(self)
+        self.battle = self.create_battle("sapphire", "t3_a")
+
+    def processed(self):
+        return sorted(row.id36 for row in
+                      self.sess.query(Processed).filter_by(battle=self.battle))
+
+    def test_processed_once(self):
+        """Each comment is recorded once, however often we see it"""
+        comments = [Comment("t1_a", "alice", "Hello", "t3_a"),
+                    Comment("t1_b", "bob", "Hi there", "t3_a")]
+        self.bot.process_comments_for_battle(comments, self.battle,
+                                             self.sess)
+        self.bot.process_comments_for_battle(comments, self.battle,
+                                             self.sess)
+        self.assertEqual(self.processed(), ["t1_a", "t1_b"])
+
+        # Also once we've forgotten what we'd seen and have to reload it
+        self.bot.seen = {}
+        self.bot.process_comments_for_battle(comments, self.battle,
+                                             self.sess)
+        self.assertEqual(self.processed(), ["t1_a", "t1_b"])
+
+    def test_reply_in_same_pass(self):
+        """Replying to a comment from this pass doesn't look it up again"""
+        comments = [Comment("t1_a", "alice", "Hello", "t3_a"),
+                    Comment("t1_b", "bob", "&gt;support with 5", "t3_a",
+                            parent_id="t1_a")]
+        self.bot.process_comments_for_battle(comments, self.battle,
+                                             self.sess)
+        self.assertEqual(self.reddit.calls, [])
+        self.assertEqual(self.processed(), ["t1_a", "t1_b"])
+
+    def test_reply_to_unknown(self):
+        """Replies to someone else's older comment look it up just once"""
+        self.reddit.things["t1_x"] = Comment("t1_x", "carol", "Hmm", "t3_a")
+        comments = [Comment("t1_a", "alice", "&gt;support with 5", "t3_a",
+                            parent_id="t1_x"),
+                    Comment("t1_b", "bob", "&gt;attack with 5", "t3_a",
+                            parent_id="t1_x")]
+        self.bot.process_comments_for_battle(comments, self.battle,
+                                             self.sess)
+        self.assertEqual(self.reddit.calls, [('get_info', "t1_x")])
+        self.assertEqual(self.processed(), ["t1_a", "t1_b", "t1_x"])
+
+    def test_reply_from_stream(self):
+        """PMs about stream comments link to them without fetching threads"""
+        comment = StreamComment(self.reddit, "t1_a", "alice", "&gt;status",
+                                "t3_a")
+        self.bot.process_comments_for_battle([comment], self.battle,
+                                             self.sess)
+        self.assertEqual(self.reddit.calls, [])
+        pm = self.sess.query(Outgoing).filter_by(kind='pm').one()
+        self.assertIn("(http://reddit.example/comments/a/_/a)", pm.body)
+
+    def test_summary_failed(self):
+        """A skirmish whose summary can't be posted isn't mentioned at all"""
+        self.alice.region = self.battle.region
+        self.sess.commit()
+        comment = Comment("t1_a", "alice", "&gt;attack with 5", "t3_a")
+        comment.reply = lambda text: None
+        self.bot.process_comments_for_battle([comment], self.battle,
+                                             self.sess)
+        self.assertEqual(self.sess.query(Outgoing).count(), 0)
+        self.assertEqual(self.battle.toplevel_skirmishes(), [])
+
+    def test_reply_without_link(self):
+        """Not being able to find a comment's link doesn't stop the reply"""
+        comment = Comment("t1_a", "alice", "&gt;status", "t3_a")
+        comment.fail = True
+        self.bot.process_comments_for_battle([comment], self.battle,
+                                             self.sess)
+        pm = self.sess.query(Outgoing).filter_by(kind='pm').one()
+        self.assertNotIn("In response to", pm.body)
+        self.assertEqual(self.processed(), ["t1_a"])
+
+
+class TestMessages(BotTest):
+
+    def setUp(self):
+        BotTest.setUp(self)
+        self.pm = Comment("t4_a", "alice", "status", was_comment=False)
+        self.reddit.unread = [self.pm]
+
+    def replies(self):
+        return self.sess.query(Outgoing).filter_by(target="t4_a").count()
+
+    def test_read_after_commit(self):
+        """PMs are marked read once what they asked for has stuck"""
+        self.bot.frame()
+        self.assert_(self.pm.read)
+        self.assertEqual(self.replies(), 1)
+
+    def test_rolled_back(self):
+        """If the frame fails, the PM is left for next time"""
+        def broken():
+            raise ValueError()
+        update_game = self.bot.update_game
+        self.bot.update_game = broken
+        self.assertFalse(self.bot.frame())
+        self.assertFalse(self.pm.read)
+        self.assertEqual(self.replies(), 0)
+
+        self.bot.update_game = update_game
+        self.bot.frame()
+        self.assert_(self.pm.read)
+        self.assertEqual(self.replies(), 1)
+
+    def test_mark_failed(self):
+        """A PM we couldn't mark read isn't acted on twice"""
+        self.pm.fail = True
+        self.bot.frame()
+        self.assertFalse(self.pm.read)
+        self.assertEqual(self.replies(), 1)
+
+        self.pm.fail = False
+        self.bot.frame()
+        self.assert_(self.pm.read)
+        self.assertEqual(self.replies(), 1)
+
+
+class TestSimulate(BotTest):
+
+    def setUp(self):
+        BotTest.setUp(self)
+        self.battle = self.create_battle("sapphire", "t3_a")
+        self.alice.region = self.battle.region
+        self.bob.region = self.battle.region
+        self.skirmish = self.battle.create_skirmish(self.alice, 10)
+        self.reaction = self.skirmish.react(self.bob, 4)
+
+    def simulate(self, text):
+        pm = Comment("t4_a", "bob", text, was_comment=False)
+        context = Context(self.bob, self.bot.config, self.sess, pm,
+                          self.reddit)
+        self.bot.command(text, context)
+        return pm.replies
+
+    def test_sample(self):
+        """Sampling a skirmish in a battle that's under way"""
+        replies = self.simulate("simulate #%d with 5" % self.reaction.id)
+        self.assertEqual(len(replies), 1)
+        self.assertIn("Against 100 random enemy responses", replies[0])
+        self.assertIn("**Skirmish #%d**" % self.skirmish.id, replies[0])
+
+    def test_what_if(self):
+        replies = self.simulate("simulate attack #%d with 20" %
+                                self.skirmish.id)
+        self.assertIn("If 20 more infantry were to attack", replies[0])
+
+    def test_no_trials(self):
+        """Simulations can be turned off with the number of trials"""
+        self.bot.config["game"]["simulations"] = 0
+        replies = self.simulate("simulate #%d with 5" % self.skirmish.id)
+        self.assertEqual(replies,
+                         ["Sorry, simulations aren't available right now"])
+
+
+class TestOutage(BotTest):
+
+    def test_clock_runs(self):
+        """The game goes on while reddit is down"""
+        for _ in range(breaker.reddit.threshold):
+            breaker.reddit.failure()
+        self.assertEqual(breaker.reddit.state, breaker.OPEN)
+        handled = []
+        self.bot.update_due = handled.append
+        self.bot.update_game()
+        self.assert_(handled)
+
+    def test_retried(self):
+        """Deadlines that fail are tried again next frame, bot still going"""
+        handled = []
+
+        def broken(due):
+            handled.append(due)
+            raise ValueError()
+        self.bot.config["bot"]["sleep"] = 0
+        self.bot.update_due = broken
+        self.assertFalse(self.bot.frame())
+        self.assert_(handled[0]['eternal'])
+
+        self.bot.update_due = handled.append
+        self.assert_(self.bot.frame())
+        self.assertEqual(len(handled), 2)
+        self.assert_(handled[1]['eternal'])
+
+
+class TestReport(BotTest):
+
+    def frame_length(self):
+        sidebar = (self.sess.query(Outgoing).filter_by(kind='settings').
+                   order_by(Outgoing.id.desc()).first())
+        return int(sidebar.body.split("Seconds per Frame: ")[1])
+
+    def test_measured(self):
+        """Seconds per frame is what the frames actually took"""
+        self.bot.generate_markdown_report(now())
+        self.assertIn(self.frame_length(), (0, 1))
+
+        start = now() - 75
+        self.bot.last_start = start - 200
+        self.bot.generate_markdown_report(start)
+        self.assertEqual(self.frame_length(), 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -139,6 +139,29 @@ class TestBattle(unittest.TestCase):
         self.assertEqual(parsed.troop_type, "cavalry")
 
 
+class TestSimulate(unittest.TestCase):
+
+    def test_what_if(self):
+        parsed = parse("simulate oppose #12 with 30 cavalry")
+        self.assertIsInstance(parsed, SimulateCommand)
+        self.assertEqual(parsed.action, "attack")
+        self.assertEqual(parsed.target, 12)
+        self.assertEqual(parsed.amount, 30)
+        self.assertEqual(parsed.troop_type, "cavalry")
+
+    def test_misspelled(self):
+        parsed = parse("simulate support #12 with 30 calvary")
+        self.assertEqual(parsed.action, "support")
+        self.assertEqual(parsed.troop_type, "cavalry")
+
+    def test_sample(self):
+        parsed = parse("simulate #7 with 20")
+        self.assertIsInstance(parsed, SimulateCommand)
+        self.assertEqual(parsed.action, None)
+        self.assertEqual(parsed.target, 7)
+        self.assertEqual(parsed.amount, 20)
+
+
 class TestCodeword(unittest.TestCase):
     def testBasicCodeword(self):
         src = 'codeword "barf" is infantry'
@@ -255,6 +278,19 @@ class TestCommandExtraction(unittest.TestCase):
         self.goodparse(text)
 
 
+class TestNames(unittest.TestCase):
+
+    def test_name_roundtrip(self):
+        pair = utils.name_to_pair("t1_c8zk2")
+        self.assertEqual(pair, (1, utils.base36decode("c8zk2")))
+        self.assertEqual(utils.pair_to_name(*pair), "t1_c8zk2")
+
+    def test_bare_id(self):
+        pair = utils.name_to_pair("1k9f")
+        self.assertEqual(pair[0], None)
+        self.assertEqual(utils.pair_to_name(*pair), "1k9f")
+
+
 class TestDefection(unittest.TestCase):
     def test_basic_defect(self):
         text = "defect"
@@ -2,8 +2,20 @@ import logging
 import time
 import unittest
 
+from requests.exceptions import ConnectionError, Timeout
+from sqlalchemy import event
+
+import breaker
 import db
+import outbound
+from atlas import Atlas
+from authors import AuthorCache
+from breaker import CircuitBreaker
+from commands import failable, retried, StatusCommand
 from db import (DB, Battle, Region, MarchingOrder, User)
+from outbound import Outbound, TokenBucket
+from scheduler import Scheduler
+from utils import now
 
 
 TEST_LANDS = """
@@ -84,6 +96,514 @@ class TestRegions(ChromaTest):
         cap = Region.capital_for(1, self.sess)
         self.assertEqual(cap.capital, cap.owner)
 
+    def test_atlas(self):
+        """The in-memory map matches the database"""
+        atlas = self.sess.atlas()
+        sapphire = self.get_region("Sapphire")
+        londo = self.get_region("Orange Londo")
+        self.assertEqual(atlas.find("sapphire"), sapphire.id)
+        self.assertEqual(atlas.find("ct_sapphire"), sapphire.id)
+        self.assertEqual(atlas.find("atlantis"), None)
+        self.assert_(atlas.adjacent(sapphire.id, londo.id))
+        self.assert_(atlas.adjacent(londo.id, sapphire.id))
+        self.assertFalse(atlas.adjacent(sapphire.id, sapphire.id))
+        self.assertIs(self.sess.atlas(), atlas)
+
+    def test_frontier(self):
+        """Each team can invade the regions next to its own"""
+        atlas = self.sess.atlas()
+        sapphire = self.get_region("Sapphire")
+        self.assertEqual(atlas.frontier[0], set([sapphire.id]))
+        self.assertEqual(atlas.frontier[1], set([sapphire.id]))
+        # Neutral Sapphire is in the way
+        self.assertEqual(atlas.contested[0], set())
+
+    def test_atlas_ownership(self):
+        """The map follows regions changing hands"""
+        atlas = self.sess.atlas()
+        pericap = self.get_region("Periopolis")
+        sapphire = self.get_region("Sapphire")
+        londo = self.get_region("Orange Londo")
+        sapphire.owner = 0
+        self.sess.commit()
+
+        self.assertIs(self.sess.atlas(), atlas)
+        self.assert_(sapphire.id in atlas.owned[0])
+        self.assertEqual(atlas.frontier[0], set([pericap.id]))
+        self.assertEqual(atlas.frontier[1], set([sapphire.id]))
+        self.assertEqual(atlas.contested[0], set([(sapphire.id, pericap.id)]))
+        self.assertEqual(atlas.contested[1], set([(pericap.id, sapphire.id)]))
+
+        # Same as if we'd started from scratch
+        fresh = Atlas([(r.id, r.name, r.srname, r.owner)
+                       for r in self.sess.query(Region)],
+                      [(r.id, other.id) for r in self.sess.query(Region)
+                       for other in r.borders])
+        for team in (0, 1):
+            self.assertEqual(atlas.frontier[team], fresh.frontier[team])
+            self.assertEqual(atlas.contested[team], fresh.contested[team])
+        self.assertEqual(atlas.route(0, londo.id, sapphire.id),
+                         fresh.route(0, londo.id, sapphire.id))
+
+    def test_frontier_status(self):
+        """The status report says where everyone can invade"""
+        status = StatusCommand.lands_status_for(self.sess, None)
+        self.assert_("Frontier:" in status)
+        self.assert_("**Orangered** can invade [sapphire](/r/ct_sapphire) "
+                     "(0 contested borders)" in status)
+
+    def test_atlas_rollback(self):
+        """Nor is a change that didn't stick kept"""
+        londo = self.get_region("Orange Londo")
+        with self.assertRaises(ValueError):
+            with self.sess.unit_of_work():
+                londo.owner = 1
+                self.assert_(londo.id in self.sess.atlas().owned[1])
+                raise ValueError()
+        self.assertFalse(londo.id in self.sess.atlas().owned[1])
+
+    def test_atlas_kept(self):
+        """Rollbacks that leave the map alone don't mean reading it again"""
+        londo = self.get_region("Orange Londo")
+        with self.sess.unit_of_work():
+            atlas = self.sess.atlas()
+            with self.assertRaises(ValueError):
+                with self.sess.savepoint():
+                    self.alice.loyalists = 10
+                    self.sess.flush()
+                    raise ValueError()
+            self.assert_(self.sess.atlas() is atlas)
+
+            with self.assertRaises(ValueError):
+                with self.sess.savepoint():
+                    londo.owner = 1
+                    self.sess.flush()
+                    raise ValueError()
+            self.assertFalse(self.sess.atlas() is atlas)
+            self.assertFalse(londo.id in self.sess.atlas().owned[1])
+
+
+class TestSession(ChromaTest):
+
+    def test_unit_of_work_rollback(self):
+        """Nothing in a failed frame sticks, even things that checkpoint()"""
+        londo = self.get_region("Orange Londo")
+        with self.assertRaises(ValueError):
+            with self.sess.unit_of_work():
+                self.alice.move(100, londo, 0)
+                self.assertEqual(self.alice.region, londo)
+                raise ValueError()
+
+        self.assertNotEqual(self.alice.region, londo)
+        self.assert_(self.alice.defectable)
+
+    def test_savepoint_isolation(self):
+        """A failed savepoint only undoes itself"""
+        londo = self.get_region("Orange Londo")
+        with self.sess.unit_of_work():
+            self.alice.move(100, londo, 0)
+            with self.assertRaises(db.TeamException):
+                with self.sess.savepoint():
+                    self.bob.defectable = False
+                    self.bob.defect(1)
+
+        self.assertEqual(self.alice.region, londo)
+        self.assert_(self.bob.defectable)
+
+    def test_on_rollback(self):
+        """Undoing follows whatever the work it's for ends up as"""
+        undone = []
+
+        def note(sess, flush_context):
+            sess.on_rollback(lambda: undone.append("flushed"))
+        event.listen(self.sess, "after_flush", note)
+
+        with self.assertRaises(ValueError):
+            with self.sess.unit_of_work():
+                self.sess.on_rollback(lambda: undone.append("frame"))
+                with self.sess.savepoint():
+                    self.sess.on_rollback(lambda: undone.append("kept"))
+                with self.assertRaises(ValueError):
+                    with self.sess.savepoint():
+                        self.alice.loyalists = 10
+                        self.sess.flush()
+                        raise ValueError()
+                self.assertEqual(undone, ["flushed"])
+                raise ValueError()
+        self.assertEqual(undone, ["flushed", "kept", "frame"])
+
+        undone[:] = []
+        with self.sess.unit_of_work():
+            self.sess.on_rollback(lambda: undone.append("committed"))
+            self.alice.loyalists = 10
+        self.assertEqual(undone, [])
+
+
+class TestScheduler(ChromaTest):
+
+    def setUp(self):
+        ChromaTest.setUp(self)
+        self.sched = Scheduler()
+        self.sched.watch(self.sess)
+
+    def test_picks_up_orders(self):
+        """New marching orders are scheduled as they're saved"""
+        londo = self.get_region("Orange Londo")
+        order = self.alice.move(100, londo, 60 * 60 * 24)
+
+        self.assertEqual(self.sched.heap, [(order.arrival, 'arrival',
+                                            order.id)])
+        self.assertFalse(self.sched.pop_due())
+        due = self.sched.pop_due(order.arrival)
+        self.assertEqual(due['arrival'], set([order.id]))
+        self.assertEqual(self.sched.heap, [])
+
+    def test_rebuild(self):
+        """Rebuilding finds everything already in the database"""
+        londo = self.get_region("Orange Londo")
+        londo.owner = None
+        battle = londo.invade(self.alice, now() + 60)
+        self.sched.heap = []
+
+        self.sched.rebuild(self.sess)
+        due = self.sched.pop_due(now() + 60)
+        self.assertEqual(due['begins'], set([battle.id]))
+        self.assert_(due['eternal'])
+
+    def test_rebuild_overdue(self):
+        """Only battles with something left to do are due straight away"""
+        londo = self.get_region("Orange Londo")
+        londo.owner = None
+        battle = londo.invade(self.alice, now() - 60)
+        battle.submission_id = "t3_a"
+        battle.ends = now() + 60
+        self.sess.commit()
+
+        # Already under way, so only its end is coming up
+        self.sched.rebuild(self.sess)
+        self.assertFalse(self.sched.pop_due()['begins'])
+        self.assertEqual(self.sched.pop_due(now() + 60)['ends'],
+                         set([battle.id]))
+
+        battle.ends = now() - 1
+        self.sess.commit()
+        self.sched.rebuild(self.sess)
+        self.assertEqual(self.sched.pop_due()['ends'], set([battle.id]))
+
+    def test_sleep_time(self):
+        """Wake up for the next deadline, but no later than usual"""
+        self.assertEqual(self.sched.sleep_time(60), 60)
+        self.sched.push(now() + 30, 'arrival', 1)
+        self.assert_(self.sched.sleep_time(60) <= 30)
+        self.assertEqual(self.sched.sleep_time(10), 10)
+
+
+class TestAuthorCache(ChromaTest):
+
+    def setUp(self):
+        ChromaTest.setUp(self)
+        self.authors = AuthorCache(size=2)
+        self.authors.watch(self.sess)
+
+    def test_cached(self):
+        """Players are only looked up by name once"""
+        self.assertEqual(self.authors.find(self.sess, "alice"), self.alice)
+        self.assertEqual(self.authors.find(self.sess, "alice"), self.alice)
+        self.assertEqual((self.authors.hits, self.authors.misses), (1, 1))
+
+    def test_lru(self):
+        """The least recently seen name is the one that's dropped"""
+        self.authors.find(self.sess, "alice")
+        self.authors.find(self.sess, "bob")
+        self.authors.find(self.sess, "alice")
+        self.authors.find(self.sess, "carol")
+        self.assertEqual(list(self.authors.entries), ["alice", "carol"])
+
+    def test_not_playing(self):
+        """Non-players are remembered too, and only told once per thread"""
+        self.assertEqual(self.authors.find(self.sess, "carol"), None)
+        self.assertEqual(self.authors.find(self.sess, "carol"), None)
+        self.assertEqual(self.authors.hits, 1)
+
+        self.assert_(self.authors.tell("carol", "t3_a"))
+        self.assertFalse(self.authors.tell("carol", "t3_a"))
+        self.assert_(self.authors.tell("carol", "t3_b"))
+
+    def test_recruited(self):
+        """Someone who joins is found from then on"""
+        self.authors.find(self.sess, "carol")
+        carol = self.create_user("carol", 0)
+        self.assertEqual(self.authors.find(self.sess, "carol"), carol)
+
+    def test_changed(self):
+        """Defection and promotion are noticed"""
+        self.authors.find(self.sess, "alice")
+        self.authors.find(self.sess, "bob")
+        self.alice.defect(1)
+        self.bob.leader = False
+        self.sess.commit()
+        self.assertEqual(len(self.authors.entries), 0)
+
+    def test_rolled_back(self):
+        """Nothing from a rolled back transaction is remembered"""
+        with self.assertRaises(ValueError):
+            with self.sess.unit_of_work():
+                carol = User(name="carol", team=0, loyalists=100)
+                self.sess.add(carol)
+                self.assertEqual(self.authors.find(self.sess, "carol"), carol)
+                raise ValueError()
+        self.assertEqual(self.authors.find(self.sess, "carol"), None)
+
+    def test_savepoint_rolled_back(self):
+        """A savepoint rolling back only forgets who changed inside it"""
+        self.authors.find(self.sess, "carol")
+        self.authors.tell("carol", "t3_a")
+        with self.sess.unit_of_work():
+            with self.assertRaises(ValueError):
+                with self.sess.savepoint():
+                    self.sess.add(User(name="dave", team=1, loyalists=100))
+                    self.authors.find(self.sess, "dave")
+                    raise ValueError()
+        self.assertEqual(list(self.authors.entries), ["carol"])
+        self.assertFalse(self.authors.tell("carol", "t3_a"))
+        self.assertEqual(self.authors.find(self.sess, "dave"), None)
+
+
+class TestOutbound(ChromaTest):
+
+    class Reddit(object):
+        """Just enough of praw to see what gets sent"""
+        def __init__(self):
+            self.sent = []
+            self.fail = 0
+
+        def send_message(self, to, subject, text):
+            if self.fail:
+                self.fail -= 1
+                raise ConnectionError()
+            self.sent.append(text)
+
+        def _add_comment(self, thing_id, text):
+            raise Timeout()
+
+    def setUp(self):
+        ChromaTest.setUp(self)
+        self.clock = [1000.0]
+        self.bucket = TokenBucket(0.5, 2, clock=lambda: self.clock[0])
+        self.reddit = self.Reddit()
+        self.breaker = CircuitBreaker(clock=lambda: self.clock[0])
+        self.outbox = Outbound(self.sess, self.reddit, self.bucket,
+                               sleep=self.sleep, breaker=self.breaker)
+
+    def sleep(self, seconds):
+        self.clock[0] += seconds
+
+    def pm(self, priority, text, to=None):
+        return self.outbox.enqueue(priority, 'pm', to or text, text, "Hi")
+
+    def test_priority(self):
+        """Most urgent first, first come first served within a class"""
+        self.pm(outbound.SIDEBAR, "sidebar")
+        self.pm(outbound.MESSAGE, "status")
+        self.pm(outbound.CONFIRMATION, "confirm1")
+        self.pm(outbound.BATTLE, "battle")
+        self.pm(outbound.CONFIRMATION, "confirm2")
+        self.sess.commit()
+        self.outbox.drain(until=self.clock[0] + 60)
+
+        self.assertEqual(self.reddit.sent, ["battle", "confirm1", "confirm2",
+                                            "status", "sidebar"])
+
+    def test_rate_limit(self):
+        """Only a burst's worth goes out at once, then it's paced"""
+        for i in range(5):
+            self.pm(outbound.MESSAGE, str(i))
+        self.assertEqual(self.outbox.drain(), 2)
+        self.assertEqual(len(self.outbox), 3)
+
+        start = self.clock[0]
+        self.assertEqual(self.outbox.drain(until=start + 4), 2)
+        self.assertEqual(self.clock[0], start + 4)
+        self.outbox.drain(until=start + 100)
+        self.assertEqual(self.reddit.sent, [str(i) for i in range(5)])
+
+    def test_idempotency(self):
+        """The same message is only queued once"""
+        self.assert_(self.pm(outbound.MESSAGE, "hello"))
+        self.assertEqual(self.pm(outbound.MESSAGE, "hello"), None)
+        self.outbox.drain()
+        self.assertEqual(self.pm(outbound.MESSAGE, "hello"), None)
+        self.assertEqual(self.reddit.sent, ["hello"])
+
+    def test_digest(self):
+        """Everything for one player goes out as a single PM"""
+        for i in range(10):
+            self.pm(outbound.CONFIRMATION, "Confirmed %d" % i, to="alice")
+        self.pm(outbound.CONFIRMATION, "Confirmed", to="bob")
+        self.assertEqual(self.outbox.drain(), 11)
+
+        self.assertEqual(len(self.reddit.sent), 2)
+        self.assertEqual(self.reddit.sent[0].split(outbound.DIGEST_SEPARATOR),
+                         ["Confirmed %d" % i for i in range(10)])
+        self.assertEqual(self.reddit.sent[1], "Confirmed")
+
+    def test_digest_limit(self):
+        """Digests that would be too long for reddit are split up"""
+        text = "x" * (outbound.MESSAGE_LIMIT / 3)
+        for i in range(3):
+            self.pm(outbound.CONFIRMATION, text + str(i), to="alice")
+        self.assertEqual(self.outbox.drain(), 3)
+
+        self.assertEqual([len(sent.split(outbound.DIGEST_SEPARATOR))
+                          for sent in self.reddit.sent], [2, 1])
+        for sent in self.reddit.sent:
+            self.assert_(len(sent) <= outbound.MESSAGE_LIMIT)
+
+    def test_superseded(self):
+        """Only the newest queued edit of something is kept"""
+        first = self.outbox.enqueue(outbound.SIDEBAR, 'settings', 'hq', "old")
+        second = self.outbox.enqueue(outbound.SIDEBAR, 'settings', 'hq',
+                                     "new")
+        self.assertIs(first, second)
+        self.assertEqual(first.body, "new")
+        self.assertEqual(len(self.outbox), 1)
+
+    def test_rolled_back(self):
+        """Nothing's sent for a command that didn't happen"""
+        try:
+            with self.sess.savepoint():
+                self.pm(outbound.CONFIRMATION, "Confirmed!")
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(len(self.outbox), 0)
+
+    def test_retry(self):
+        """Failures that can't have gone through are tried again later"""
+        self.reddit.fail = 1
+        self.pm(outbound.MESSAGE, "hello")
+        self.assertEqual(self.outbox.drain(until=self.clock[0] + 60), 0)
+        self.assertEqual(self.outbox.drain(until=self.clock[0] + 60), 1)
+        self.assertEqual(self.reddit.sent, ["hello"])
+
+    def test_no_double_posting(self):
+        """A reply that might have gone through isn't tried again"""
+        item = self.outbox.enqueue(outbound.CONFIRMATION, 'reply', 't1_a',
+                                   "Confirmed")
+        self.outbox.drain(until=self.clock[0] + 60)
+        self.assertEqual(item.state, 'failed')
+        self.assertEqual(len(self.outbox), 0)
+
+    def test_breaker(self):
+        """Nothing is tried while reddit is down"""
+        self.breaker.state = breaker.OPEN
+        self.breaker.opened_at = self.clock[0]
+        self.pm(outbound.MESSAGE, "hello")
+        self.assertEqual(self.outbox.drain(), 0)
+        self.assertEqual(len(self.outbox), 1)
+        # Nor are any tokens used up on it
+        self.assertEqual(self.bucket.tokens, 2)
+
+        self.clock[0] += self.breaker.cooldown
+        self.assertEqual(self.outbox.drain(), 1)
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+
+    def test_recover(self):
+        """After a crash, only resend what's safe to"""
+        reply = self.outbox.enqueue(outbound.CONFIRMATION, 'reply', 't1_a',
+                                    "Confirmed")
+        edit = self.outbox.enqueue(outbound.BATTLE, 'edit', 't3_b', "Over")
+        reply.state = edit.state = 'sending'
+        self.sess.commit()
+
+        self.outbox.recover()
+        self.assertEqual(reply.state, 'failed')
+        self.assertEqual(edit.state, 'queued')
+
+
+class TestBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = [1000.0]
+        self.slept = []
+        self.old = breaker.reddit
+        breaker.reddit = CircuitBreaker(threshold=3, window=60, cooldown=120,
+                                        retries=2,
+                                        clock=lambda: self.clock[0],
+                                        sleep=self.slept.append)
+        self.calls = 0
+
+    def tearDown(self):
+        breaker.reddit = self.old
+
+    def flaky(self, failures):
+        def call():
+            self.calls += 1
+            if self.calls <= failures:
+                raise ConnectionError()
+            return "ok"
+        return call
+
+    def test_retried(self):
+        """Calls safe to repeat are retried with growing waits"""
+        self.assertEqual(retried(self.flaky(2))(), "ok")
+        self.assertEqual(self.calls, 3)
+        self.assertEqual(len(self.slept), 2)
+        self.assert_(0 <= self.slept[0] <= 1)
+        self.assert_(0 <= self.slept[1] <= 2)
+
+    def test_not_retried(self):
+        """Other calls only get the one chance"""
+        self.assertEqual(failable(self.flaky(1))(), None)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.slept, [])
+
+    def test_nested(self):
+        """Only the call that actually reaches reddit is counted"""
+        inner = failable(self.flaky(0))
+        outer = failable(lambda: inner())
+        self.assertEqual(outer(), "ok")
+        self.assertEqual(breaker.reddit.calls, 1)
+
+        failing = failable(lambda: failable(self.flaky(2))())
+        self.assertEqual(failing(), None)
+        self.assertEqual((breaker.reddit.calls, breaker.reddit.failures),
+                         (2, 1))
+
+    def test_trips(self):
+        """Once enough calls fail, the rest are skipped until it's back"""
+        call = failable(self.flaky(3))
+        for _ in range(5):
+            self.assertEqual(call(), None)
+        self.assertEqual(self.calls, 3)
+        self.assertEqual(breaker.reddit.state, breaker.OPEN)
+        self.assertEqual(breaker.reddit.skipped, 2)
+        self.assert_("down" in breaker.reddit.describe())
+
+        # After the cooldown, one success closes it again
+        self.clock[0] += 120
+        self.assertEqual(call(), "ok")
+        self.assertEqual(breaker.reddit.state, breaker.CLOSED)
+        self.assertEqual(breaker.reddit.trips, 1)
+
+    def test_failed_recovery(self):
+        """A failure while it's checking on reddit opens it straight away"""
+        call = failable(self.flaky(4))
+        for _ in range(3):
+            call()
+        self.clock[0] += 120
+        call()
+        self.assertEqual(breaker.reddit.state, breaker.OPEN)
+        self.assertEqual(breaker.reddit.trips, 2)
+
+    def test_old_failures(self):
+        """Failures spread out over time don't trip it"""
+        call = failable(self.flaky(10))
+        for _ in range(10):
+            call()
+            self.clock[0] += 30
+        self.assertEqual(breaker.reddit.state, breaker.CLOSED)
+
 
 class TestPlaying(ChromaTest):
 
@@ -217,7 +737,7 @@ class TestPlaying(ChromaTest):
 
         # Invoke the update routine to set everyone's location
         arrived = MarchingOrder.update_all(self.sess)
-        self.assert_(arrived)
+        self.assertEqual(arrived, {"arrived": [order], "underway": []})
 
         # Now we're there!
         self.assertEqual(londo, self.alice.region)
@@ -240,6 +760,88 @@ class TestPlaying(ChromaTest):
             filter_by(leader=self.alice)).count()
         self.assertEqual(n, 1)
 
+    def test_route(self):
+        """Routes only go through friendly territory"""
+        atlas = self.sess.atlas()
+        cap = self.alice.region
+        londo = self.get_region("Orange Londo")
+        sapphire = self.get_region("Sapphire")
+        pericap = self.get_region("Periopolis")
+
+        self.assertEqual(atlas.route(0, cap.id, londo.id), (londo.id,))
+        self.assertEqual(atlas.route(0, cap.id, sapphire.id),
+                         (londo.id, sapphire.id))
+        # Sapphire's neutral, so no going through it
+        self.assertEqual(atlas.route(0, cap.id, pericap.id), None)
+        self.assertEqual(atlas.route(1, pericap.id, londo.id), None)
+
+    def test_multihop_movement(self):
+        """Can go more than one region at once"""
+        sapphire = self.get_region("Sapphire")
+        sapphire.owner = 0
+        self.sess.commit()
+
+        self.alice.move(100, sapphire, 0)
+        self.assertEqual(self.alice.region, sapphire)
+
+    def test_delayed_multihop_movement(self):
+        """Each region on the way takes as long as a move would"""
+        home = self.alice.region
+        londo = self.get_region("Orange Londo")
+        sapphire = self.get_region("Sapphire")
+        sapphire.owner = 0
+        self.sess.commit()
+
+        order = self.alice.move(100, sapphire, 60 * 60)
+        self.assertEqual(order.hops(), [londo.id, sapphire.id])
+        self.assertEqual(order.final_arrival(), order.arrival + 60 * 60)
+        self.assertEqual(order.dest, sapphire)
+
+        order.arrival = now()
+        self.sess.commit()
+        result = MarchingOrder.update_all(self.sess)
+        self.assertEqual(result, {"arrived": [], "underway": [order]})
+        # Halfway there
+        self.assertEqual(self.alice.region, londo)
+        self.assertEqual(order.source, londo)
+        self.assertEqual(order.hops(), [sapphire.id])
+        self.assertFalse(order.has_arrived())
+
+        order.arrival = now()
+        self.sess.commit()
+        MarchingOrder.update_all(self.sess)
+        self.assertEqual(self.alice.region, sapphire)
+        self.assertEqual(self.sess.query(MarchingOrder).count(), 0)
+        self.assertNotEqual(home, sapphire)
+
+    def test_multihop_catch_up(self):
+        """Legs that all finished while we weren't looking are all done"""
+        sapphire = self.get_region("Sapphire")
+        sapphire.owner = 0
+        self.sess.commit()
+
+        order = self.alice.move(100, sapphire, 60 * 60)
+        order.arrival = now() - 60 * 60
+        self.sess.commit()
+        MarchingOrder.update_all(self.sess)
+        self.assertEqual(self.alice.region, sapphire)
+        self.assertEqual(self.sess.query(MarchingOrder).count(), 0)
+
+    def test_multihop_halt(self):
+        """Armies stop short if the way ahead is lost"""
+        londo = self.get_region("Orange Londo")
+        sapphire = self.get_region("Sapphire")
+        sapphire.owner = 0
+        self.sess.commit()
+
+        order = self.alice.move(100, sapphire, 60 * 60)
+        sapphire.owner = 1
+        order.arrival = now()
+        self.sess.commit()
+        MarchingOrder.update_all(self.sess)
+        self.assertEqual(self.alice.region, londo)
+        self.assertEqual(self.sess.query(MarchingOrder).count(), 0)
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,225 @@
+import random
+import unittest
+
+import resolver
+from resolver import ATTACK_ORDER, Forest, Node, Scoreboard, resolve_forest
+from simulation import Simulation
+
+
+def random_forest(rng, size, roots=3):
+    """Random skirmish forest, with small amounts so there are plenty of ties"""
+    nodes = []
+    for i in range(1, size + 1):
+        if i <= roots:
+            parent = None
+        else:
+            parent = rng.randint(1, i - 1)
+        nodes.append(Node(i, parent, rng.randint(0, 1), rng.randint(1, 12),
+                          rng.random() < 0.6, rng.choice(ATTACK_ORDER)))
+    return nodes
+
+
+def results(nodes):
+    return dict((node.id, node.results()) for node in nodes)
+
+
+def copies(nodes):
+    return [Node(n.id, n.parent_id, n.team, n.amount, n.hinder, n.troop_type)
+            for n in nodes]
+
+
+class TestResolver(unittest.TestCase):
+
+    def test_simple(self):
+        """Same as battletest's test_simple_resolve, without the database"""
+        root = Node(1, None, 0, 10, True, 'infantry')
+        nodes = [root, Node(2, 1, 1, 9, True, 'infantry')]
+        tops = resolve_forest(nodes)
+
+        self.assertEqual(tops, [root])
+        self.assertEqual(root.victor, 0)
+        self.assertEqual(root.margin, 1)
+        self.assertEqual(root.vp, 9)
+
+    def test_forest(self):
+        """Several roots resolve independently"""
+        nodes = [Node(1, None, 0, 10, True, 'infantry'),
+                 Node(2, None, 1, 15, True, 'infantry'),
+                 Node(3, 1, 1, 8, True, 'cavalry')]
+        tops = resolve_forest(nodes)
+
+        self.assertEqual(len(tops), 2)
+        self.assertEqual(nodes[0].victor, 1)
+        self.assertEqual(nodes[0].margin, 2)
+        self.assertEqual(nodes[1].vp, 30)
+        self.assert_(nodes[1].unopposed)
+
+    def test_deep_chain(self):
+        """Long reply chains mustn't hit the recursion limit"""
+        depth = 20000
+        nodes = [Node(1, None, 0, 10, True, 'infantry')]
+        for i in range(2, depth + 1):
+            nodes.append(Node(i, i - 1, i % 2, 10 + i, True, 'infantry'))
+        resolve_forest(nodes)
+
+        self.assert_(all(node.victor is not None or node.margin == 0
+                         for node in nodes))
+        # Nothing answers the deepest attack, so it carries the day
+        self.assertEqual(nodes[-1].victor, depth % 2)
+        self.assertEqual(nodes[-1].margin, 10 + depth)
+        self.assertEqual(nodes[-2].victor, depth % 2)
+        self.assertEqual(nodes[-2].margin, 1)
+
+
+class TestScoreboard(unittest.TestCase):
+
+    def test_incremental(self):
+        """Adding actions one at a time agrees with resolving from scratch"""
+        rng = random.Random(1234)
+        for trial in range(30):
+            nodes = random_forest(rng, rng.randint(1, 40),
+                                  roots=rng.randint(1, 4))
+            board = Scoreboard([])
+            for count, node in enumerate(nodes, 1):
+                board.add(node)
+
+                fresh = copies(nodes[:count])
+                resolve_forest(fresh)
+                self.assertEqual(results(nodes[:count]), results(fresh))
+
+                score = [0, 0]
+                for n in fresh:
+                    if n.is_root and n.victor is not None:
+                        score[n.victor] += n.vp
+                self.assertEqual(board.score, score)
+
+    def test_existing(self):
+        """Starting from a forest, then adding to it"""
+        board = Scoreboard([Node(1, None, 0, 10, True, 'infantry')])
+        self.assertEqual(board.score, [20, 0])
+
+        board.add(Node(2, 1, 1, 9, True, 'infantry'))
+        self.assertEqual(board.score, [9, 0])
+        board.add(Node(3, None, 1, 15, True, 'infantry'))
+        self.assertEqual(board.score, [9, 30])
+
+@unittest.skipIf(resolver.numpy is None, "numpy isn't installed")
+class TestForest(unittest.TestCase):
+
+    def test_differential(self):
+        """The batch resolver agrees with the node-at-a-time one"""
+        rng = random.Random(4242)
+        for trial in range(200):
+            size = rng.randint(1, 60)
+            nodes = random_forest(rng, size, roots=rng.randint(1, 4))
+            resolve_forest(nodes)
+            expected = results(nodes)
+
+            forest = Forest(nodes)
+            forest.store(*forest.resolve())
+            self.assertEqual(results(nodes), expected)
+
+    def test_subtree(self):
+        """A subtree's top isn't a root, so gets no unopposed bonus"""
+        rng = random.Random(99)
+        nodes = random_forest(rng, 40, roots=1)
+        subtree = [node for node in nodes if node.parent_id == 1]
+        resolve_forest(subtree)
+        expected = results(subtree)
+
+        forest = Forest(subtree)
+        forest.store(*forest.resolve())
+        self.assertEqual(results(subtree), expected)
+
+    def test_variations(self):
+        """Extra dimensions of amounts resolve independently"""
+        rng = random.Random(7)
+        nodes = random_forest(rng, 30)
+        forest = Forest(nodes)
+        amounts = [[rng.randint(1, 12) for _ in nodes] for _ in range(5)]
+        victor, vp, margin, unopposed = forest.resolve(amounts)
+
+        for row, amount in enumerate(amounts):
+            for node, howmany in zip(forest.nodes, amount):
+                node.amount = howmany
+            resolve_forest(nodes)
+            for i, node in enumerate(forest.nodes):
+                self.assertEqual(node.vp, vp[row, i])
+                self.assertEqual(node.margin, margin[row, i])
+
+    def test_batch(self):
+        """resolve_batch hands back the tops, just like resolve_forest"""
+        nodes = [Node(1, None, 0, 10, True, 'infantry'),
+                 Node(2, 1, 1, 9, True, 'infantry')]
+        tops = resolver.resolve_batch(nodes)
+
+        self.assertEqual(tops, nodes[:1])
+        self.assertEqual(nodes[0].victor, 0)
+        self.assertIs(nodes[0].unopposed, False)
+
+
+
+@unittest.skipIf(resolver.numpy is None, "numpy isn't installed")
+class TestSimulation(unittest.TestCase):
+
+    def setUp(self):
+        # Skirmish 1 from battletest's test_full_battle, plus skirmish 2
+        self.nodes = [Node(1, None, 0, 10, True, 'infantry'),
+                      Node(2, 1, 0, 4, False, 'infantry'),
+                      Node(3, 2, 1, 3, True, 'infantry'),
+                      Node(4, 1, 1, 8, True, 'infantry'),
+                      Node(5, None, 1, 15, True, 'infantry')]
+
+    def test_copy(self):
+        """Only the asked-for tree is copied, and the originals untouched"""
+        sim = Simulation(self.nodes, 1)
+        self.assertEqual(sorted(node.id for node in sim.nodes), [1, 2, 3, 4])
+        self.assertNotIn(5, sim)
+        sim.what_if(3, True, 5, 'cavalry')
+        self.assertEqual(self.nodes[2].children, [])
+
+    def test_what_if(self):
+        sim = Simulation(self.nodes, 1)
+        before, after = sim.what_if(1, True, 10, 'infantry')
+
+        self.assertEqual(before, (0, 3, 11))
+        self.assertEqual(after, (1, 7, 14))
+
+    def test_what_if_matches(self):
+        """what_if agrees with resolving the tree by hand"""
+        rng = random.Random(31337)
+        for trial in range(50):
+            nodes = random_forest(rng, rng.randint(1, 30), roots=1)
+            sim = Simulation(nodes, 1)
+            parent = rng.choice(nodes)
+            hinder = rng.random() < 0.5
+            amount = rng.randint(1, 12)
+            troop_type = rng.choice(ATTACK_ORDER)
+            before, after = sim.what_if(parent.id, hinder, amount,
+                                        troop_type)
+
+            fresh = copies(nodes)
+            resolve_forest(fresh)
+            self.assertEqual(before, (fresh[0].victor, fresh[0].margin,
+                                      fresh[0].vp))
+            team = 1 - parent.team if hinder else parent.team
+            fresh.append(Node(-1, parent.id, team, amount, hinder,
+                              troop_type))
+            resolve_forest(fresh)
+            self.assertEqual(after, (fresh[0].victor, fresh[0].margin,
+                                     fresh[0].vp))
+
+    def test_sample(self):
+        sim = Simulation(self.nodes, 1)
+        won, tied, lost = sim.sample(0, 20, 3000, seed=1)
+        self.assertEqual(won + tied + lost, 3000)
+        # Some responses are too small to matter, some are big enough to
+        # swing it
+        self.assert_(won > 0)
+        self.assert_(lost > 0)
+
+        # A single troop never makes a difference to a margin of 3
+        self.assertEqual(sim.sample(0, 1, 100), (100, 0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
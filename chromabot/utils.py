@@ -7,6 +7,15 @@ def base36decode(number):
     return int(number, 36)
 
 
+def base36encode(number):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    result = ""
+    while number:
+        number, i = divmod(number, 36)
+        result = digits[i] + result
+    return result or "0"
+
+
 def extract_command(text):
     text = text.strip()
     regex = re.compile(r"(?:\n|^)&gt;(.*)")
@@ -24,6 +33,28 @@ def name_to_id(name):
     return results[1]
 
 
+def name_to_pair(name):
+    """
+    Convert a reddit name of the form t3_xx to a (3, int('xx', 36)) pair for
+    compact storage.  Bare ids without a kind give a kind of None.
+    """
+    if name is None:
+        return None, None
+    if "_" in name:
+        kind, id36 = name.split("_", 1)
+        return int(kind.lstrip("t")), base36decode(id36)
+    return None, base36decode(name)
+
+
+def pair_to_name(kind, num):
+    """The reverse of name_to_pair"""
+    if num is None:
+        return None
+    if kind is None:
+        return base36encode(num)
+    return "t%d_%s" % (kind, base36encode(num))
+
+
 def now():
     return time.mktime(time.localtime())
 